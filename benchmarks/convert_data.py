@@ -0,0 +1,35 @@
+"""
+Benchmark of the conversion of a WRDS file (serial vs parallel).
+
+Usage:
+    python benchmarks/convert_data.py <file.sas7bdat|file.csv> [cores]
+"""
+
+import sys
+import time
+import tempfile
+import pywrds as pw
+
+
+def run(filename, cores=None):
+    w = pw.wrds(tempfile.mkdtemp())
+    if cores is not None:
+        w.set_cores_no(cores)
+    results = {}
+    for mode, parallel in [('serial', False), ('parallel', True)]:
+        start = time.perf_counter()
+        w.convert_data(filename, force=True, parallel=parallel)
+        results[mode] = time.perf_counter() - start
+    print("Conversion of {} ({} cores)".format(filename, w.cores))
+    for mode, t in results.items():
+        print("  {:10s}{:10.2f}s".format(mode, t))
+    print("  speedup   {:10.2f}x".format(results['serial'] /
+                                         results['parallel']))
+    return(results)
+
+
+if __name__ == '__main__':
+    cores = None
+    if len(sys.argv) > 2:
+        cores = int(sys.argv[2])
+    run(sys.argv[1], cores)
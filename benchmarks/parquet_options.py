@@ -0,0 +1,61 @@
+"""
+File size and read throughput (open_data) of a converted WRDS file under
+different parquet options (codec, dictionary encoding, row groups).
+
+Usage:
+    python benchmarks/parquet_options.py <file.sas7bdat|file.csv> [repeat]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import pywrds as pw
+
+policies = [
+    ('snappy (default)', {}),
+    ('snappy, no dictionary', {'dictionary': False}),
+    ('snappy, registry dictionary', {'dictionary': 'registry'}),
+    ('lz4', {'compression': 'lz4'}),
+    ('zstd', {'compression': 'zstd'}),
+    ('zstd 9, registry dictionary', {'compression': 'zstd',
+                                     'compression_level': 9,
+                                     'dictionary': 'registry'}),
+    ('zstd, 1M rows row groups', {'compression': 'zstd',
+                                  'row_group_size': 1 << 20}),
+]
+
+
+def data_size(path):
+    if os.path.isfile(path):
+        return(os.path.getsize(path))
+    return(sum(os.path.getsize(os.path.join(r, f))
+               for r, _, fs in os.walk(path) for f in fs))
+
+
+def run(filename, repeat=3):
+    print("{:32s}{:>10s}{:>12s}{:>10s}{:>12s}".format(
+        'Policy', 'Size (MB)', 'Convert (s)', 'Read (s)', 'Rows/s'))
+    for label, options in policies:
+        w = pw.wrds(tempfile.mkdtemp())
+        w.set_cache_size(0)
+        w.set_parquet_options(**options)
+        start = time.perf_counter()
+        name = w.convert_data(filename)
+        tconv = time.perf_counter() - start
+        size = data_size(w.datadir+name+'.parquet')
+        tread = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            df = w.open_data(name)
+            t = time.perf_counter() - start
+            tread = t if tread is None else min(tread, t)
+        print("{:32s}{:10.1f}{:12.2f}{:10.3f}{:12.0f}".format(
+            label, size/1e6, tconv, tread, len(df)/tread))
+
+
+if __name__ == '__main__':
+    repeat = 3
+    if len(sys.argv) > 2:
+        repeat = int(sys.argv[2])
+    run(sys.argv[1], repeat)
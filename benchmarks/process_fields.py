@@ -0,0 +1,68 @@
+"""
+Per-chunk timing of the decoding of byte strings (wrds._process_fields)
+on a wide synthetic SAS-like chunk, compared with the previous
+cell-by-cell implementation.
+
+Usage:
+    python benchmarks/process_fields.py [nrows] [ncols]
+"""
+
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pywrds as pw
+
+
+def _process_fields_cells(df):
+    """ Previous implementation (type of each cell checked in python). """
+    for c in df.columns:
+        if df[c].dtype == object:
+            df[c] = df[c].where(df[c].apply(type) != bytes,
+                                df[c].str.decode('utf-8', errors='ignore'))
+    return df
+
+
+def synthetic_chunk(nrows, ncols):
+    """ Chunk as returned by pd.read_sas: byte strings (with missing
+    values) and float columns.
+    """
+    rng = np.random.default_rng(0)
+    words = np.array([b'INDL', b'STD', b'C', b'D', b'USD', b'FS',
+                      b'ALPHABET INC', b'MICROSOFT CORP'], dtype=object)
+    data = {}
+    for i in range(ncols):
+        if i % 4 == 0:
+            data['X'+str(i)] = rng.standard_normal(nrows)
+        else:
+            col = words[rng.integers(0, len(words), nrows)]
+            col[rng.random(nrows) < .1] = np.nan
+            data['C'+str(i)] = col
+    return(pd.DataFrame(data))
+
+
+def run(nrows=10000, ncols=400, repeat=3):
+    df = synthetic_chunk(nrows, ncols)
+    byte_columns = [c for c in df.columns if c.startswith('C')]
+    impl = {'cells': lambda d: _process_fields_cells(d),
+            'bulk': lambda d: pw.wrds._process_fields(d),
+            'bulk (SAS metadata)':
+                lambda d: pw.wrds._process_fields(d, byte_columns)}
+    results = {}
+    for k, fn in impl.items():
+        times = []
+        for _ in range(repeat):
+            d = df.copy()
+            start = time.perf_counter()
+            fn(d)
+            times += [time.perf_counter() - start]
+        results[k] = min(times)
+    print("Decoding of a {}x{} chunk".format(nrows, ncols))
+    for k, t in results.items():
+        print("  {:22s}{:8.3f}s".format(k, t))
+    return(results)
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    run(*args)
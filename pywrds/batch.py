@@ -0,0 +1,258 @@
+"""
+Provides the batch conversion of WRDS files (for instance to set up a new
+data directory or to update it with a cron job).
+
+The batch is a list of files (module, name, path) or a yaml file:
+
+    datadir: /data/wrds
+    processes: 4
+    memory: 16G
+    files:
+      - [comp, funda, /wrds/comp/funda.sas7bdat]
+      - [crsp, msf, /wrds/crsp/msf.sas7bdat]
+      - module: crsp
+        name: dsf
+        path: /wrds/crsp/dsf.sas7bdat
+        partition_on: date
+
+The other keys of a file are passed to convert_data (columns, partition_on,
+incremental, checkpoint, sample, types, csv_engine) and 'memory' overrides
+the estimate of the memory used by its conversion.
+"""
+
+from pywrds import wrds, wrds_module
+from pywrds.pywrds import _source_format, _open_source
+import pandas as pd
+import multiprocessing as mp
+import argparse
+import sys
+import queue
+import yaml
+import os
+
+
+# Name of the modules of the wrds object
+modules_aliases = {'tr': 'tr13f', 'sec': 'sec13f'}
+
+
+def convert_batch(w, files, processes=None, memory=None, force=False):
+    """ Convert a batch of files and register the converted files on
+    their module (as add_file).
+    The largest files are converted first, in parallel in 'processes'
+    processes as long as the estimated memory of the running conversions
+    stays within the memory budget (at least one conversion runs).
+    Arguments:
+        w --    wrds object (data directory and conversion options).
+        files --    List of files (module, name, path), (module, name,
+                    path, options) or {'module', 'name', 'path', options}
+                    (see the module documentation).
+        processes --    Number of conversions at the same time
+                        (w.cores by default). The files are converted one
+                        at a time if the identifiers are encoded (shared
+                        dictionaries).
+        memory --   Memory budget in bytes (None for no budget).
+        force --    If True, convert the files again (see convert_data).
+                    Can be set by file ('force' option).
+    Return the names of the converted files {(module, name): name}.
+    An exception lists the files whose conversion failed (the other files
+    are converted and registered).
+    """
+    w._check_data_dir()
+    jobs = [_job(w, f) for f in files]
+    for job in jobs:
+        job['options'].setdefault('force', force)
+    # Largest files first
+    jobs = sorted(jobs, key=lambda j: os.path.getsize(j['path']),
+                  reverse=True)
+    if processes is None:
+        processes = w.cores
+    if w.identifiers is not None:
+        processes = 1
+    processes = max(1, min(processes, len(jobs)))
+    settings = {'chunksize': w.chunksize,
+                'date_type': w.date_type,
+                'identifiers': w.identifiers,
+                'parquet_options': w.parquet_options}
+    results = {}
+    errors = {}
+
+    def done(job, name=None, error=None):
+        key = (job['module'], job['name'])
+        if error is not None:
+            errors[key] = error
+        else:
+            setattr(job['object'], job['name'], name)
+            results[key] = name
+        print("Batch conversion: {}.{} {} ({}/{})".format(
+            job['module'], job['name'], 'failed' if error else 'done',
+            len(results)+len(errors), len(jobs)))
+
+    if processes == 1:
+        for job in jobs:
+            try:
+                done(job, w.convert_data(job['path'], **job['options']))
+            except Exception as e:
+                done(job, error=e)
+    else:
+        finished = queue.Queue()
+        pool = mp.Pool(processes)
+        try:
+            pending = list(jobs)
+            running = []
+            while len(pending) > 0 or len(running) > 0:
+                # Start the largest files that fit in the memory budget
+                for job in list(pending):
+                    if len(running) >= processes:
+                        break
+                    used = sum(j['memory'] for j in running)
+                    if (len(running) > 0 and memory is not None and
+                            used+job['memory'] > memory):
+                        continue
+                    pending.remove(job)
+                    running.append(job)
+                    pool.apply_async(
+                        _convert_job,
+                        (w.datadir, settings, job['path'], job['options']),
+                        callback=lambda n, j=job: finished.put((j, n, None)),
+                        error_callback=lambda e, j=job: finished.put(
+                            (j, None, e)))
+                job, name, error = finished.get()
+                running.remove(job)
+                done(job, name, error)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    # The conversions of other processes are not in the cache
+    w.clear_cache()
+    if len(errors) > 0:
+        raise Exception("The conversion failed for: " +
+                        ", ".join("{}.{} ({})".format(m, n, e)
+                                  for (m, n), e in errors.items()))
+    return(results)
+
+
+def read_batch(path):
+    """ Return the content of a batch file (yaml): data directory,
+    processes, memory budget and files (see the module documentation).
+    """
+    with open(path) as f:
+        batch = yaml.safe_load(f) or {}
+    if 'memory' in batch:
+        batch['memory'] = _memory(batch['memory'])
+    return(batch)
+
+
+def main(args=None):
+    """ Console entry point: convert the files of a batch file. """
+    parser = argparse.ArgumentParser(
+        description="Convert a batch of WRDS files to the data directory.")
+    parser.add_argument('batch', help="batch file (yaml)")
+    parser.add_argument('--datadir', help="data directory")
+    parser.add_argument('--processes', type=int,
+                        help="number of conversions at the same time")
+    parser.add_argument('--memory', help="memory budget (for instance 16G)")
+    parser.add_argument('--force', action='store_true',
+                        help="convert the files again")
+    args = parser.parse_args(args)
+    batch = read_batch(args.batch)
+    datadir = args.datadir or batch.get('datadir')
+    if datadir is None:
+        parser.error("the data directory is not defined")
+    memory = batch.get('memory')
+    if args.memory is not None:
+        memory = _memory(args.memory)
+    w = wrds(datadir)
+    try:
+        convert_batch(w, batch.get('files', []),
+                      processes=args.processes or batch.get('processes'),
+                      memory=memory, force=args.force)
+    except Exception as e:
+        print(e)
+        return(1)
+    return(0)
+
+
+def _job(w, f):
+    """ Return the job of a file of the batch: module, name, path,
+    module object, options of convert_data and estimated memory.
+    """
+    if isinstance(f, dict):
+        options = {k: v for k, v in f.items()
+                   if k not in ['module', 'name', 'path', 'memory']}
+        job = {'module': f['module'], 'name': f['name'], 'path': f['path'],
+               'memory': f.get('memory')}
+    else:
+        options = dict(f[3]) if len(f) > 3 else {}
+        job = {'module': f[0], 'name': f[1], 'path': f[2],
+               'memory': options.pop('memory', None)}
+    job['object'] = getattr(w, modules_aliases.get(job['module'],
+                                                   job['module']), None)
+    if not isinstance(job['object'], wrds_module):
+        raise Exception("Unknown module {}".format(job['module']))
+    if not os.path.exists(job['path']):
+        raise Exception("The file {} does not exist".format(job['path']))
+    # No pool of processes within the conversions
+    options['parallel'] = False
+    job['options'] = options
+    if job['memory'] is None:
+        job['memory'] = _memory_estimate(job['path'], w.chunksize)
+    else:
+        job['memory'] = _memory(job['memory'])
+    return(job)
+
+
+def _convert_job(datadir, settings, path, options):
+    """ Convert a file in a worker process (with the settings of the
+    wrds object of the batch).
+    """
+    w = wrds(datadir)
+    w.set_chunksize(settings['chunksize'])
+    w.set_date_type(settings['date_type'])
+    w.set_identifiers(settings['identifiers'])
+    w.set_parquet_options(**settings['parquet_options'])
+    w.set_cache_size(0)
+    return(w.convert_data(path, **options))
+
+
+def _memory_estimate(path, chunksize):
+    """ Return an estimate of the memory used by the conversion of a file
+    (bytes): a few copies of a chunk of raw data (raw, decoded, arrow
+    table and written row groups).
+    """
+    _, ext, compression = _source_format(path)
+    if compression is None:
+        source = open(path, 'rb')
+        size = os.path.getsize(path)
+    else:
+        source, _ = _open_source(path, compression)
+        size = None  # Size of the decompressed file not known
+    try:
+        if ext == '.sas7bdat':
+            f = pd.read_sas(source, format='sas7bdat', chunksize=1)
+            chunk = f.row_length*chunksize
+        else:
+            # Blocks of the arrow csv reader (or chunks of the pandas
+            # reader)
+            lines = source.read(1 << 20).split(b'\n')
+            row = sum(len(x)+1 for x in lines) / float(max(len(lines), 1))
+            chunk = max(row*chunksize, 1 << 25)
+    finally:
+        source.close()
+    if size is not None:
+        chunk = min(size, chunk)
+    return(int(4*chunk))
+
+
+def _memory(value):
+    """ Return a memory size in bytes (integer or string such as '16G'). """
+    if isinstance(value, str):
+        units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+        value = value.strip().upper().rstrip('B')
+        if value[-1:] in units:
+            return(int(float(value[:-1])*units[value[-1]]))
+    return(int(value))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,7 @@
 Provides processing functions for the CBOE data
 """
 
-from pywrds import wrds_module
+from pywrds import wrds_module, lookup
 
 
 class cboe(wrds_module):
@@ -14,10 +14,9 @@ class cboe(wrds_module):
 
     def get_fields(self, data, fields):
         key = ['date']
-        df = self.w.open_data(self.cboe, key+fields)
-        # Merge to the use data
         dfu = self.w.open_data(data, [self.w.col_date])
         dfu['date'] = dfu[self.w.col_date]
-        dfin = dfu.merge(df, how='left', on=key)
-        dfin.index = dfu.index
-        return(dfin[fields])
+        # Only the dates of the user data are read
+        df = (self.w.dataset(self.cboe).select(key+fields)
+              .join(dfu[key], on=key, how='semi').to_pandas())
+        return(lookup(dfu, df, key, fields))
@@ -2,7 +2,7 @@
 Provides processing functions for Compustat data
 """
 
-from pywrds import wrds_module
+from pywrds import wrds_module, lookup
 import pandas as pd
 
 
@@ -39,17 +39,29 @@ class comp(wrds_module):
             fields --   Fields from file_fund
         """
         key = ['gvkey', 'datadate']
-        cols_req = key + ['indfmt', 'datafmt', 'consol', 'popsrc']
         data_key = self.w.open_data(data, key)
-        index = data_key.index
-        comp = self.w.open_data(self.fund,
-                                key+fields+cols_req).drop_duplicates()
         # Filter the fund data
-        comp = comp[comp.indfmt.isin(self.indfmt) &
-                    comp.datafmt.isin(self.datafmt) &
-                    comp.consol.isin(self.consol) &
-                    comp.popsrc.isin(self.popsrc)]
-        comp = comp[key+fields]
+        filters = {'indfmt': self.indfmt,
+                   'datafmt': self.datafmt,
+                   'consol': self.consol,
+                   'popsrc': self.popsrc}
+        # Only read the dates of the user data (all the dates are needed
+        # to compute the lags)
+        dates = self.w.get_data_range(data_key, 'datadate')
+        if lag == 0 and dates is not None:
+            filters['datadate'] = dates
+            # Data partitioned by fiscal year: the fiscal year ends at most
+            # one year before datadate (records without fiscal year are
+            # not read).
+            if 'fyear' in self.w.get_partition_keys(self.fund):
+                years = (pd.Timestamp(dates[0]).year-1,
+                         pd.Timestamp(dates[1]).year)
+                filters['fyear'] = years
+        # Only read the firms of the user data
+        comp = (self.w.dataset(self.fund).select(key+fields)
+                .filter(filters)
+                .join(data_key, on=['gvkey'], how='semi')
+                .to_pandas().drop_duplicates())
         # Remove duplicates
         dup = comp[key].duplicated(keep=False)
         nd0 = comp[~dup]
@@ -72,10 +84,8 @@ class comp(wrds_module):
         # Get the lags if asked for
         ndl = nd.groupby('gvkey')[fields].shift(lag)
         nd[fields] = ndl
-        # Merge and return the fields
-        dfin = data_key.merge(nd, how='left', on=key)
-        dfin.index = index
-        return(dfin[fields])
+        # Look up and return the fields
+        return(lookup(data_key, nd, key, fields))
 
     def _get_names_fields(self, fields, data):
         """ Returns the fields from COMPUSTAT.
@@ -86,13 +96,10 @@ class comp(wrds_module):
         """
         key = ['gvkey']
         data_key = self.w.open_data(data, key)
-        index = data_key.index
         comp = self.w.open_data(self.names, key+fields).drop_duplicates()
         # Note: thereare no duplicates in the name file
-        # Merge and return the fields
-        dfin = data_key.merge(comp, how='left', on=key)
-        dfin.index = index
-        return(dfin[fields])
+        # Look up and return the fields
+        return(lookup(data_key, comp, key, fields))
 
     def get_fields(self, fields, data=None, lag=0):
         """ Returns the fields from COMPUSTAT.
@@ -137,12 +144,9 @@ class comp(wrds_module):
             # df[fields] = dfl
         # Construct the object to return
         if data is not None:
-            # Merge and return the fields
+            # Look up and return the fields
             data_key = self.w.open_data(data, key)
-            index = data_key.index
-            dfin = data_key.merge(df, how='left', on=key)
-            dfin.index = index
-            return(dfin[fields])
+            return(lookup(data_key, df, key, fields))
         else:
             # Return the entire dataset with keys
             return(df[key+fields])
@@ -176,11 +180,9 @@ class comp(wrds_module):
         if lag != 0:
             stdl = std.groupby('gvkey')[fields].shift(lag)
             std[fields] = stdl
-        # Merge to the data
+        # Look up the values for the data
         dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(std[key+fields], how='left', on=key)
-        dfin.index = dfu.index
-        return(dfin[fields])
+        return(lookup(dfu, std, key, fields))
 
     ##########################
     # Variables Computations #
@@ -191,11 +193,9 @@ class comp(wrds_module):
             key = ['gvkey', 'datadate']
             df = self.get_fields(key+fields)
             df['v'] = fn(df)
-            # Merge to the data
+            # Look up the values for the data
             dfu = self.w.open_data(data, key)
-            dfin = dfu.merge(df[key+['v']], how='left', on=key)
-            dfin.index = dfu.index
-            return(dfin.v)
+            return(lookup(dfu, df, key, 'v'))
         setattr(self, fn.__name__, _var)
 
     def _blevq(self, data):
@@ -222,12 +222,10 @@ class comp(wrds_module):
         df['monthQ1'] = (df.fyr + 2) % 12 + 1
         condQ1 = df.month == df.monthQ1
         df.loc[condQ1, 'capxq'] = df[condQ1].capxy
-        # Merge to the data
+        # Look up the values for the data
         dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(df[key+['capxq']], how='left', on=key)
-        dfin.index = dfu.index
         # Return the field
-        return(dfin.capxq)
+        return(lookup(dfu, df, key, 'capxq'))
 
     def _dvtq(self, data):
         """ Return quarterly dividends.
@@ -245,12 +243,10 @@ class comp(wrds_module):
         df['monthQ1'] = (df.fyr + 2) % 12 + 1
         condQ1 = df.month == df.monthQ1
         df.loc[condQ1, 'dvtq'] = df[condQ1].dvy
-        # Merge to the data
+        # Look up the values for the data
         dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(df[key+['dvtq']], how='left', on=key)
-        dfin.index = dfu.index
         # Return the field
-        return(dfin.dvtq)
+        return(lookup(dfu, df, key, 'dvtq'))
 
     def _epsd(self, data):
         """ Returns Diluted EPS. """
@@ -295,11 +291,9 @@ class comp(wrds_module):
         df['hhiq'] = df.groupby(gk).s2.transform('sum')
         # hhi = df.groupby(gk).s2.sum().reset_index(name='hhiq')
         # df = df.merge(hhi, how='left', on=gk)
-        # Merge to the data
+        # Look up the values for the data
         dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(df[key+['hhiq']], how='left', on=key)
-        dfin.index = dfu.index
-        return(df.hhiq)
+        return(lookup(dfu, df, key, 'hhiq'))
 
     def _litig(self, data):
         """ Litigation dummy.
@@ -352,11 +346,9 @@ class comp(wrds_module):
         df['numfq'] = df.groupby(gk).gvkey.transform('count')
         # ms = df.groupby(gk).gvkey.count().reset_index(name='numfq')
         # df = df.merge(ms, how='left', on=gk)
-        # Merge to the data
+        # Look up the values for the data
         dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(df[key+['numfq']], how='left', on=key)
-        dfin.index = dfu.index
-        return(df.numfq)
+        return(lookup(dfu, df, key, 'numfq'))
 
     def _oaccq(self, data):
         """ Return Operating Accruals (Quarterly). """
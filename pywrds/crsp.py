@@ -2,10 +2,101 @@
 Provides processing functions for CRSP data
 """
 
-from pywrds import wrds_module
+from pywrds import wrds_module, lookup
+from pywrds import crspcomp
+from pywrds.pywrds import _write_json
 import pandas as pd
 import numpy as np
 import pandas_market_calendars as mcal
+import json
+import os
+
+
+# Measures of the rolling statistics of the daily data
+# {measure: (dsf fields, series from the fields, statistic)}
+rolling_measures = {
+    'cret': (['ret'], lambda d: np.log1p(d.ret), 'compounded'),
+    'vol': (['ret'], lambda d: d.ret, 'std'),
+    'bas': (['bid', 'ask'], lambda d: d.ask - d.bid, 'mean'),
+    'bas_lohi': (['bidlo', 'askhi'], lambda d: d.askhi - d.bidlo, 'mean'),
+    'turnover': (['shrout', 'vol'], lambda d: d.vol / (d.shrout * 1000),
+                 'mean'),
+}
+
+
+class trading_calendar:
+    """ Trading days of an exchange indexed by integer sessions
+    (position of the trading day in the calendar).
+    Arguments:
+        days -- Trading days.
+        start --    First day covered by the calendar.
+        end --  Last day covered by the calendar.
+    """
+
+    def __init__(self, days, start, end):
+        days = pd.to_datetime(pd.Series(days)).to_numpy()
+        self.days = np.unique(days.astype('datetime64[D]'))
+        self.start = pd.Timestamp(start)
+        self.end = pd.Timestamp(end)
+
+    def covers(self, dates):
+        """ Return True if the calendar covers the dates. """
+        if dates is None:
+            return(True)
+        dates = pd.to_datetime(pd.Series(dates)).dropna()
+        return(len(dates) == 0 or (dates.min() >= self.start and
+                                   dates.max() <= self.end))
+
+    def session(self, dates, t='past'):
+        """ Return the sessions (integer positions) of the closest trading
+        days of the dates, in the past (t='past') or in the future
+        (t='future'). -1 if there is none (or missing date).
+        """
+        days = pd.to_datetime(pd.Series(dates)).to_numpy()
+        missing = pd.isna(days)
+        days = days.astype('datetime64[D]')
+        if t == 'past':
+            pos = np.searchsorted(self.days, days, side='right') - 1
+        else:
+            pos = np.searchsorted(self.days, days, side='left')
+        pos[missing | (pos >= len(self.days))] = -1
+        return(pos)
+
+    def date(self, sessions, index=None):
+        """ Return the trading days of the sessions (NaT for the sessions
+        outside the calendar).
+        """
+        sessions = np.asarray(sessions)
+        valid = (sessions >= 0) & (sessions < len(self.days))
+        days = np.full(len(sessions), np.datetime64('NaT'),
+                       dtype='datetime64[ns]')
+        days[valid] = self.days[sessions[valid]]
+        return(pd.Series(days, index=index))
+
+    def closest(self, dates, t='past'):
+        """ Return the closest trading days of the dates, in the past
+        (t='past') or in the future (t='future'), the date itself if it is
+        a trading day.
+        """
+        dates = pd.Series(dates)
+        return(self.date(self.session(dates, t), dates.index))
+
+    def offset(self, dates, k, t='past'):
+        """ Return the trading days k sessions after the closest trading
+        days of the dates (k sessions before if k < 0).
+        """
+        dates = pd.Series(dates)
+        pos = self.session(dates, t)
+        pos = np.where(pos >= 0, pos + k, -1)
+        return(self.date(pos, dates.index))
+
+    def is_trading_day(self, dates):
+        """ Return True for the dates that are trading days. """
+        dates = pd.Series(dates)
+        days = pd.to_datetime(dates).to_numpy().astype('datetime64[D]')
+        pos = np.searchsorted(self.days, days)
+        pos = np.minimum(pos, len(self.days)-1)
+        return(pd.Series(self.days[pos] == days, index=dates.index))
 
 
 class crsp(wrds_module):
@@ -20,6 +111,8 @@ class crsp(wrds_module):
         self.linkprim = ['P', 'C']
         # Default data frequency
         self.freq = 'M'
+        # NYSE trading calendar (see get_calendar)
+        self._calendar = None
 
     def set_frequency(self, frequency):
         if frequency in ['Monthly', 'monthly', 'M', 'm']:
@@ -37,44 +130,25 @@ class crsp(wrds_module):
         Arguments:
             data -- User provided data.
                     Required columns: [gvkey, 'col_date']
-            link_table --   WRDS provided linktable (ccmxpf_lnkhist)
-            linktype -- Default: [LC, LU]
-            linkprim -- Default: [P, C]
+        Uses the link table self.linktable (WRDS ccmxpf_lnkhist, the link
+        table of the package if not set), self.linktype (default: [LC, LU])
+        and self.linkprim (default: [P, C]).
+        """
+        permno = crspcomp.permno_from_gvkey(
+            self.w, data, getattr(self, 'linktable', None), self.linktype,
+            self.linkprim, col_date=self.w.col_date)
+        return(permno.astype('float32'))
+
+    def gvkey_from_permno(self, data):
+        """ Returns COMPUSTAT gvkey from CRSP permno.
+        Arguments:
+            data -- User provided data.
+                    Required columns: [permno, 'col_date']
+        Uses the same links as permno_from_gvkey.
         """
-        # Columns required from data
-        key = ['gvkey', self.w.col_date]
-        # Columns required from the link table
-        cols_link = ['gvkey', 'lpermno', 'linktype', 'linkprim',
-                     'linkdt', 'linkenddt']
-        # Open the data
-        data_key = self.w.open_data(data, key).drop_duplicates().dropna()
-        link = self.w.open_data(self.linktable, cols_link)
-        link = link.dropna(subset=['gvkey', 'lpermno', 'linktype', 'linkprim'])
-        # Retrieve the specified links
-        link = link[(link.linktype.isin(self.linktype)) &
-                    (link.linkprim.isin(self.linkprim))]
-        link = link[['gvkey', 'lpermno', 'linkdt', 'linkenddt']]
-        # Merge the data
-        dm = data_key.merge(link, how='left', on='gvkey')
-        # Filter the dates (keep correct matches)
-        cond1 = (pd.notna(dm.linkenddt) &
-                 (dm[self.w.col_date] >= dm.linkdt) &
-                 (dm[self.w.col_date] <= dm.linkenddt))
-        cond2 = (pd.isna(dm.linkenddt) & (dm['datadate'] >= dm.linkdt))
-        dm = dm[cond1 | cond2]
-        # Rename lpermno to permno and remove unnecessary columns
-        dm = dm.rename(columns={'lpermno': 'permno'})
-        dm = dm[['gvkey', self.w.col_date, 'permno']]
-        # Check for duplicates on the key
-        n_dup = dm.shape[0] - dm[key].drop_duplicates().shape[0]
-        if n_dup > 0:
-            print("Warning: The merged permno",
-                  "contains {:} duplicates".format(n_dup))
-        # Add the permno to the user's data
-        dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(dm, how='left', on=key)
-        dfin.index = dfu.index
-        return(dfin.permno.astype('float32'))
+        return(crspcomp.gvkey_from_permno(
+            self.w, data, getattr(self, 'linktable', None), self.linktype,
+            self.linkprim, col_date=self.w.col_date))
 
     def permno_from_cusip(self, data):
         """ Returns CRSP permno from CUSIP.
@@ -84,14 +158,11 @@ class crsp(wrds_module):
                     The cusip needs to be the CRSP ncusip.
         """
         dfu = self.w.open_data(data, ['cusip'])
-        cs = dfu.drop_duplicates()
         pc = self.w.open_data(self.msenames, ['ncusip', 'permno'])
-        pc = pc.drop_duplicates()
-        cs = cs.merge(pc, how='left', left_on=['cusip'], right_on=['ncusip'])
-        csf = cs[['cusip', 'permno']].dropna().drop_duplicates()
-        dfin = dfu.merge(csf, how='left', on='cusip')
-        dfin.index = dfu.index
-        return(dfin.permno.astype('float32'))
+        pc = pc.dropna().drop_duplicates()
+        permno = lookup(dfu, pc, 'ncusip', 'permno', on='cusip',
+                        duplicates='warn')
+        return(permno.astype('float32'))
 
     def _adjust_shares(self, data, col_shares):
         """ Adjust the number of shares using CRSP cfacshr field.
@@ -105,7 +176,6 @@ class crsp(wrds_module):
         # Open and prepare the user data
         cols = ['permno', col_shares, self.w.col_date]
         dfu = self.w.open_data(data, cols)
-        index = dfu.index
         dt = pd.to_datetime(dfu[self.w.col_date]).dt
         dfu['year'] = dt.year
         dfu['month'] = dt.month
@@ -115,14 +185,12 @@ class crsp(wrds_module):
         dt = pd.to_datetime(df.date).dt
         df['year'] = dt.year
         df['month'] = dt.month
-        # Merge the data
+        # Look up the adjustment factors
         key = ['permno', 'year', 'month']
-        dfu = dfu[key+[col_shares]].merge(df[key+['cfacshr']],
-                                          how='left', on=key)
+        dfu['cfacshr'] = lookup(dfu, df, key, 'cfacshr')
         dfu.loc[dfu.cfacshr.isna(), 'cfacshr'] = 1
         # Compute the adjusted shares
         dfu['adj_shares'] = dfu[col_shares] * dfu.cfacshr
-        dfu.index = index
         return(dfu.adj_shares.astype('float32'))
 
     def _get_fields_dsf(self, fields, data=None):
@@ -138,18 +206,17 @@ class crsp(wrds_module):
         key = ['permno', 'date']
         # Get the fields
         # Note: CRSP data is clean without duplicates
-        df = self.w.open_data(self.dsf, key+fields)
+        dsf = self.w.dataset(self.dsf).select(key+fields)
         # Construct the object to return
         if data is not None:
-            # Merge and return the fields
+            # Look up and return the fields (only the permnos and dates
+            # of the user data are read)
             data_key = self.w.open_data(data, key)
-            index = data_key.index
-            dfin = data_key.merge(df, how='left', on=key)
-            dfin.index = index
-            return(dfin[fields])
+            dsf = dsf.join(data_key, on=key, how='semi').to_pandas()
+            return(lookup(data_key, dsf, key, fields))
         else:
             # Return the entire dataset with keys
-            return(df)
+            return(self.w.open_data(self.dsf, key+fields))
 
     def get_fields_daily(self, fields, data):
         """ Returns the fields from CRSP daily.
@@ -168,23 +235,167 @@ class crsp(wrds_module):
         dfu[fields] = self._get_fields_dsf(fields, dfu)
         return(dfu[fields])
 
+    def get_calendar(self, dates=None):
+        """ Return the NYSE trading calendar (trading_calendar) covering
+        the dates (from the start of CRSP to the end of next year by
+        default). The calendar is built once and saved in the data
+        directory (nyse_calendar.parquet). It is extended when dates
+        outside the calendar are requested.
+        """
+        if self._calendar is not None and self._calendar.covers(dates):
+            return(self._calendar)
+        start = pd.Timestamp('1925-12-31')
+        end = pd.Timestamp(pd.Timestamp.today().year+1, 12, 31)
+        path = None
+        if self.w.datadir is not None:
+            path = self.w.datadir+'nyse_calendar'
+            if os.path.exists(path+'.json'):
+                with open(path+'.json') as f:
+                    bounds = json.load(f)
+                cal = trading_calendar(
+                    pd.read_parquet(path+'.parquet').date,
+                    bounds['start'], bounds['end'])
+                if cal.covers(dates):
+                    self._calendar = cal
+                    return(cal)
+                start = min(start, cal.start)
+                end = max(end, cal.end)
+        if dates is not None:
+            d = pd.to_datetime(pd.Series(dates)).dropna()
+            if len(d) > 0:
+                start = min(start, d.min().normalize())
+                end = max(end, d.max().normalize())
+        nyse = mcal.get_calendar('NYSE')
+        days = nyse.schedule(start, end).index
+        cal = trading_calendar(days, start, end)
+        if path is not None:
+            pd.DataFrame({'date': cal.days}).to_parquet(path+'.parquet',
+                                                        index=False)
+            _write_json(path+'.json', {'start': str(start.date()),
+                                       'end': str(end.date())})
+        self._calendar = cal
+        return(cal)
+
     def _closest_trading_date(self, dates, t='past'):
         """ Return the closest trading day either in the past (t='past')
         or in the future (t='future').
         Based on opening days ofthe NYSE. """
-        dates = pd.to_datetime(dates)
-        nyse = mcal.get_calendar('NYSE')
-        mind = dates.min()
-        maxd = dates.max()
-        dates_nyse = nyse.schedule(mind, maxd).market_open.dt.date
-        sm = (~dates.dt.date.isin(dates_nyse)).astype(int)
-        for i in range(0, 6):
-            if t == 'past':
-                dates = dates - pd.to_timedelta(sm, unit='d')
+        cal = self.get_calendar(dates)
+        return(self.w.to_dates(cal.closest(dates, t)))
+
+    def rolling_stats(self, specs, data=None, col_date=None):
+        """ Return rolling statistics of the CRSP daily data over windows
+        of trading days (rows of the stock), all computed in a single
+        pass: the daily data is read and sorted by (permno, date) once and
+        the statistics are differences of prefix sums (sums of squares for
+        the volatility).
+        A statistic is missing when the window is not complete (start or
+        end of the stock data or missing values in the window).
+        Arguments:
+            specs --    List of (measure, window, direction):
+                        measure --  'cret' (compounded return), 'vol'
+                                    (volatility of returns), 'bas'
+                                    (average bid-ask spread), 'bas_lohi'
+                                    (average spread between bidlo and
+                                    askhi) or 'turnover' (average daily
+                                    turnover).
+                        window --   Number of trading days.
+                        direction --    'past' (window ending at the date)
+                                        or 'future' (window starting at
+                                        the date).
+            data -- User data.
+                    Required columns: [permno, 'col_date']
+                    If None, return the statistics of the entire daily
+                    data with the key.
+            col_date -- Date column of the user data (self.w.col_date if
+                        None).
+        Return one column by spec named '<measure>_<window>_<direction>'.
+        """
+        key = ['permno', 'date']
+        for measure, window, direction in specs:
+            if measure not in rolling_measures:
+                raise Exception("Unknown rolling measure {}".format(measure))
+            if direction not in ['past', 'future'] or window < 1:
+                raise Exception("The window should be a positive number " +
+                                "of days in the 'past' or 'future'")
+        fields = []
+        for measure, _, _ in specs:
+            fields += rolling_measures[measure][0]
+        fields = list(dict.fromkeys(fields))
+        # Open the daily data (only the permnos of the user data)
+        if data is not None:
+            if col_date is None:
+                col_date = self.w.col_date
+            dfu = self.w.open_data(data, ['permno', col_date])
+            dfu = dfu.rename(columns={col_date: 'date'})
+            permnos = sorted(dfu.permno.dropna().unique().tolist())
+            dsf = self.w.open_data(self.dsf, key+fields,
+                                   filters={'permno': permnos})
+        else:
+            dsf = self.w.open_data(self.dsf, key+fields)
+        # Sort once by (permno, date)
+        dsf = dsf.sort_values(key, kind='mergesort').reset_index(drop=True)
+        permno = dsf.permno.to_numpy()
+        n = len(dsf)
+        new = np.ones(n, dtype=bool)
+        new[1:] = permno[1:] != permno[:-1]
+        starts = np.flatnonzero(new)
+        group = np.cumsum(new) - 1
+        first = starts[group]
+        last = np.append(starts[1:], n)[group]
+        rows = np.arange(n)
+        stats = pd.DataFrame(index=dsf.index)
+        prefix = {}
+        for measure, window, direction in specs:
+            _, fn, stat = rolling_measures[measure]
+            if measure not in prefix:
+                prefix[measure] = _prefix_sums(fn(dsf), permno, stat)
+            p, p2, count = prefix[measure]
+            if direction == 'past':
+                lo, hi = rows - window + 1, rows + 1
+                valid = lo >= first
+            else:
+                lo, hi = rows, rows + window
+                valid = hi <= last
+            lo, hi = np.clip(lo, 0, n), np.clip(hi, 0, n)
+            valid &= (count[hi] - count[lo]) == window
+            s = p[hi] - p[lo]
+            if stat == 'compounded':
+                v = np.expm1(s)
+            elif stat == 'mean':
+                v = s / window
             else:
-                dates = dates + pd.to_timedelta(sm, unit='d')
-            sm = (~dates.dt.date.isin(dates_nyse)).astype(int)
-        return(dates.dt.date)
+                s2 = p2[hi] - p2[lo]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    var = (s2 - s**2/window) / (window-1)
+                v = np.sqrt(np.maximum(var, 0))
+                valid &= window > 1
+            name = '{}_{}_{}'.format(measure, window, direction)
+            stats[name] = np.where(valid, v, np.nan).astype('float32')
+        names = list(stats.columns)
+        if data is None:
+            return(pd.concat([dsf[key], stats], axis=1))
+        stats[key] = dsf[key]
+        return(lookup(dfu, stats, key, names))
+
+    def _rolling_stat(self, measure, data, ndays, useall, name=None):
+        """ Return a rolling statistic (see rolling_stats) for the user
+        data over 'ndays' days (in the past if ndays<0, in the future
+        otherwise), using the closest trading day if useall.
+        The statistic is named 'name' (the measure if None).
+        """
+        cols_data = ['permno', self.w.col_date]
+        dfu = self.w.open_data(data, cols_data)
+        direction = 'future' if ndays > 0 else 'past'
+        # Use the last or next trading day if requested
+        if useall is True:
+            dfu['date'] = self._closest_trading_date(dfu[self.w.col_date],
+                                                     t=direction)
+        else:
+            dfu['date'] = dfu[self.w.col_date]
+        spec = (measure, abs(ndays), direction)
+        stats = self.rolling_stats([spec], dfu, col_date='date')
+        return(stats.iloc[:, 0].rename(name or measure).astype('float32'))
 
     def compounded_daily_return(self, data, ndays=1, useall=True):
         r"""
@@ -202,27 +413,9 @@ class crsp(wrds_module):
                         compounded return of the next available trading day
                         (if ndays>0).
         """
-        # Open the necessary data
+        if self.w.backend != 'duckdb':
+            return(self._rolling_stat('cret', data, ndays, useall))
         key = ['permno', 'date']
-        fields = ['ret']
-        dsf = self._get_fields_dsf(fields)
-        # Create the time series index
-        dsf = dsf.set_index('date')
-        # Compute the compounded returns
-        if ndays == 1:
-            dsf['cret'] = dsf.ret
-        else:
-            window = abs(ndays)
-            dsf['ln1ret'] = np.log(1 + dsf.ret)
-            s = dsf.groupby('permno').rolling(window).ln1ret.sum()
-            if ndays < 0:
-                dsf['s'] = s.values
-            else:
-                dsf['s'] = s.shift(1-ndays).values
-            dsf['cret'] = np.exp(dsf.s) - 1
-            # dsf = dsf.drop(['ln1ret', 's'], 1)
-        # dsf = dsf.drop('ret', 1).reset_index()
-        dsf = dsf.reset_index()
         # Use the last or next trading day if requested
         cols_data = ['permno', self.w.col_date]
         dfu = self.w.open_data(data, cols_data)
@@ -235,9 +428,27 @@ class crsp(wrds_module):
             dfu['date'] = self._closest_trading_date(dfu[self.w.col_date], t=t)
         else:
             dfu['date'] = dfu[self.w.col_date]
-        # Merge the cumulative return to the data
-        dfin = dfu.merge(dsf[key+['cret']], how='left', on=key)
-        dfin.index = index
+        # Window over the returns of the permnos of the user data
+        window = abs(ndays)
+        frame = 'ROWS BETWEEN {} PRECEDING AND CURRENT ROW'
+        if ndays > 0:
+            frame = 'ROWS BETWEEN CURRENT ROW AND {} FOLLOWING'
+        dfu['__row__'] = np.arange(len(dfu))
+        dfin = self.w.sql("""
+            SELECT u.__row__, c.cret FROM u LEFT JOIN (
+                SELECT permno, date,
+                    CASE WHEN count(ret) OVER w = {window}
+                    THEN product(1+CAST(ret AS DOUBLE)) OVER w - 1
+                    END AS cret
+                FROM "{dsf}"
+                WHERE permno IN (SELECT permno FROM u)
+                WINDOW w AS (PARTITION BY permno ORDER BY date {frame})
+            ) c ON u.permno = c.permno AND u.date = c.date
+            ORDER BY u.__row__
+            """.format(window=window, dsf=self.dsf,
+                       frame=frame.format(window-1)),
+            u=dfu[key+['__row__']])
+        dfin.index = index[dfin.__row__.values]
         return(dfin.cret.astype('float32'))
 
     def volatility_daily_return(self, data, ndays=1, useall=True):
@@ -256,36 +467,7 @@ class crsp(wrds_module):
                         volatility of the next available trading day
                         (if ndays>0).
         """
-        # Open the necessary data
-        key = ['permno', 'date']
-        fields = ['ret']
-        dsf = self._get_fields_dsf(fields)
-        # Create the time series index
-        dsf = dsf.set_index('date')
-        # Compute the volatility
-        window = abs(ndays)
-        vol = dsf.groupby('permno').rolling(window).ret.std()
-        if ndays < 0:
-            dsf['vol'] = vol.values
-        else:
-            dsf['vol'] = vol.shift(1-ndays).values
-        dsf = dsf.reset_index()
-        # Use the last or next trading day if requested
-        cols_data = ['permno', self.w.col_date]
-        dfu = self.w.open_data(data, cols_data)
-        index = dfu.index
-        # Shift a maximum of 6 days
-        if useall is True:
-            t = 'past'
-            if ndays > 0:
-                t = 'future'
-            dfu['date'] = self._closest_trading_date(dfu[self.w.col_date], t=t)
-        else:
-            dfu['date'] = dfu[self.w.col_date]
-        # Merge the cumulative return to the data
-        dfin = dfu.merge(dsf[key+['vol']], how='left', on=key)
-        dfin.index = index
-        return(dfin.vol.astype('float32'))
+        return(self._rolling_stat('vol', data, ndays, useall))
 
     def average_daily_bas(self, data, ndays=1, useall=True, bas=None):
         r"""
@@ -306,44 +488,14 @@ class crsp(wrds_module):
                     'bid' and 'ask' from CRSP. If 'lohi', use the fields
                     'bidlo' and 'askhi' from CRSP.
         """
-        # Open the necessary data
-        key = ['permno', 'date']
-        fields = ['bid', 'ask']
         if bas is None:
-            fs = ['bid', 'ask']
+            measure = 'bas'
         elif bas == 'lohi':
-            fs = ['bidlo', 'askhi']
+            measure = 'bas_lohi'
         else:
             raise Exception("'bas' argument only accepts None or 'lohi'.")
-        dsf = self._get_fields_dsf(fs)
-        dsf.columns = key + fields
-        # Create the time series index
-        dsf = dsf.set_index('date')
-        # Compute the average bid-ask spread
-        dsf['spread'] = dsf.ask - dsf.bid
-        window = abs(ndays)
-        s = dsf.groupby('permno').rolling(window).spread.mean()
-        if ndays < 0:
-            dsf['average'] = s.values
-        else:
-            dsf['average'] = s.shift(1-ndays).values
-        dsf = dsf.reset_index()
-        # Use the last or next trading day if requested
-        cols_data = ['permno', self.w.col_date]
-        dfu = self.w.open_data(data, cols_data)
-        index = dfu.index
-        # Shift a maximum of 6 days
-        if useall is True:
-            t = 'past'
-            if ndays > 0:
-                t = 'future'
-            dfu['date'] = self._closest_trading_date(dfu[self.w.col_date], t=t)
-        else:
-            dfu['date'] = dfu[self.w.col_date]
-        # Merge the cumulative return to the data
-        dfin = dfu.merge(dsf[key+['average']], how='left', on=key)
-        dfin.index = index
-        return(dfin.average.astype('float32'))
+        return(self._rolling_stat(measure, data, ndays, useall,
+                                  name='average'))
 
     def daily_turnover(self, data, ndays=1, useall=True):
         r"""
@@ -360,40 +512,10 @@ class crsp(wrds_module):
                         available trading date (if ndays<0) or the
                         turnover of the next available trading day
                         (if ndays>0).
+        Note: The number of shares outstanding (shrout) is in thousands and
+        the volume in the daily data is expressed in units of shares.
         """
-        # Open the necessary data
-        key = ['permno', 'date']
-        fields = ['shrout', 'vol']
-        # Note: The number of shares outstanding (shrout) is in thousands.
-        # Note: The volume in the daily data is expressed in units of shares.
-        dsf = self._get_fields_dsf(fields)
-        # Create the time series index
-        dsf = dsf.set_index('date')
-        # Compute the average bid-ask spread
-        dsf['vol_sh'] = dsf.vol / (dsf.shrout * 1000)
-        window = abs(ndays)
-        s = dsf.groupby('permno').rolling(window).vol_sh.mean()
-        if ndays < 0:
-            dsf['turnover'] = s.values
-        else:
-            dsf['turnover'] = s.shift(1-ndays).values
-        dsf = dsf.reset_index()
-        # Use the last or next trading day if requested
-        cols_data = ['permno', self.w.col_date]
-        dfu = self.w.open_data(data, cols_data)
-        index = dfu.index
-        # Shift a maximum of 6 days
-        if useall is True:
-            t = 'past'
-            if ndays > 0:
-                t = 'future'
-            dfu['date'] = self._closest_trading_date(dfu[self.w.col_date], t=t)
-        else:
-            dfu['date'] = dfu[self.w.col_date]
-        # Merge the cumulative return to the data
-        dfin = dfu.merge(dsf[key+['turnover']], how='left', on=key)
-        dfin.index = index
-        return(dfin.turnover.astype('float32'))
+        return(self._rolling_stat('turnover', data, ndays, useall))
 
     ##########################
     # Variables Computations #
@@ -418,6 +540,25 @@ class crsp(wrds_module):
             dfu['month'] = dt.month
         else:
             dfu['date'] = dfu[self.w.col_date]
-        dfin = dfu.merge(df[key+['tso']], how='left', on=key)
-        dfin.index = dfu.index
-        return(dfin.tso)
+        return(lookup(dfu, df, key, 'tso'))
+
+
+def _prefix_sums(x, permno, stat):
+    """ Return the prefix sums of the values (missing values counted as 0),
+    of their squares for the volatility (centered by stock to limit the
+    rounding errors) and the prefix counts of the non missing values
+    (arrays of length len(x)+1 starting at 0).
+    """
+    x = pd.Series(x).to_numpy(dtype='float64', na_value=np.nan)
+    ok = np.isfinite(x)
+    x = np.where(ok, x, 0)
+    p2 = None
+    if stat == 'std':
+        count = pd.Series(ok).groupby(permno).transform('sum').to_numpy()
+        total = pd.Series(x).groupby(permno).transform('sum').to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = np.where(ok, x - total/np.maximum(count, 1), 0)
+        p2 = np.concatenate([[0], np.cumsum(x**2)])
+    p = np.concatenate([[0], np.cumsum(x)])
+    count = np.concatenate([[0], np.cumsum(ok)])
+    return(p, p2, count)
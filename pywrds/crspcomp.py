@@ -3,7 +3,16 @@ Provide merging and processing function for CRSP / Compustat
 """
 
 # import pywrds as pw
+from pywrds.pywrds import wrds, interval_index, _write_json, _remove_data
+from pywrds.pywrds import _parquet_options, _filters_mask
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import multiprocessing as mp
+import json
+import hashlib
+import os
 # import datetime as dt
 
 "Merge Compustat and CRSP data"
@@ -41,108 +50,325 @@ import pandas as pd
 # end_date: yyyy/mm/dd (value is 99999999 if still effective)
 
 
-def gvkey_from_permno(w, file_data, link_table):
-    None
+# Link table shipped with the package (used when no link table is given)
+link_table_default = os.path.join(os.path.dirname(__file__), 'datadir',
+                                  'ccmxpf_lnkhist.parquet')
 
+# Link indexes in memory {(source, version, linktype, linkprim): indexes}
+_link_indexes = {}
 
-def permno_from_gvkey(w, data, link_table,
-                      linktype=['LC', 'LU'], linkprim=['P', 'C']):
-    """ Returns CRSP permno from COMPUSTAT gvkey.
+
+def link_index(w, link_table=None, linktype=['LC', 'LU'],
+               linkprim=['P', 'C'], reverse=False):
+    """ Return the index of the CCM links (interval_index): permnos linked
+    to each gvkey between linkdt and linkenddt, or gvkeys linked to each
+    permno if reverse.
+    The indexes are built once and cached in the data directory
+    (ccm_links.<hash>.*, one set of files per version of the link table,
+    linktype and linkprim).
     Arguments:
-        data -- User provided data.
-                Required columns: ['gvkey', 'datadate']
-        link_table --   WRDS provided linktable (ccmxpf_lnkhist)
+        link_table --   WRDS provided linktable (ccmxpf_lnkhist) converted
+                        in the data directory (the link table of the
+                        package if None).
         linktype -- Default: [LC, LU]
         linkprim -- Default: [P, C]
+        reverse --  If True, return the permno -> gvkey index.
+    """
+    if link_table is None:
+        source = link_table_default
+        version = os.stat(source).st_mtime_ns
+    else:
+        source = link_table
+        version = w.get_data_version(link_table)
+    state = {'source': source, 'version': version,
+             'linktype': sorted(linktype), 'linkprim': sorted(linkprim)}
+    mkey = (source, version, tuple(state['linktype']),
+            tuple(state['linkprim']))
+    if mkey not in _link_indexes:
+        links = None
+        if w.datadir is not None:
+            h = hashlib.sha256(json.dumps(
+                state, sort_keys=True).encode()).hexdigest()[:16]
+            path = w.datadir+'ccm_links.'+h
+            paths = [path+'.gvkey.parquet', path+'.permno.parquet']
+            cached = None
+            if os.path.exists(path+'.json'):
+                with open(path+'.json') as f:
+                    cached = json.load(f)
+            if cached == state and all(os.path.exists(p) for p in paths):
+                links = [pd.read_parquet(p) for p in paths]
+        if links is None:
+            link = _links(w, link_table, linktype, linkprim)
+            links = [link.sort_values(['gvkey', 'linkdt']),
+                     link.sort_values(['permno', 'linkdt'])]
+            if w.datadir is not None:
+                for df, p in zip(links, paths):
+                    df.to_parquet(p, index=False)
+                _write_json(path+'.json', state)
+        _link_indexes[mkey] = (
+            interval_index(links[0], 'gvkey', 'linkdt', 'linkenddt',
+                           'permno'),
+            interval_index(links[1], 'permno', 'linkdt', 'linkenddt',
+                           'gvkey'))
+    return(_link_indexes[mkey][1 if reverse else 0])
+
+
+def _links(w, link_table, linktype, linkprim):
+    """ Return the links of the link table (gvkey, permno, linkdt,
+    linkenddt) of the link types and primary links.
     """
-    index = data.index
-    # Columns required from data
-    key = ['gvkey', 'datadate']
-    # Columns required from the link table
     cols_link = ['gvkey', 'lpermno', 'linktype', 'linkprim',
                  'linkdt', 'linkenddt']
-    # Open the data
-    data_key = w.open_data(data, key).drop_duplicates().dropna()
-    link = w.open_data(link_table, cols_link)
+    if link_table is None:
+        link = pd.read_parquet(link_table_default, columns=cols_link)
+        link['gvkey'] = pd.to_numeric(link.gvkey).astype('float32')
+    else:
+        link = w.open_data(link_table, cols_link)
     link = link.dropna(subset=['gvkey', 'lpermno', 'linktype', 'linkprim'])
     # Retrieve the specified links
     link = link[(link.linktype.isin(linktype)) &
                 (link.linkprim.isin(linkprim))]
-    link = link[['gvkey', 'lpermno', 'linkdt', 'linkenddt']]
-    # Merge the data
-    dm = data_key.merge(link, how='left', on='gvkey')
-    # Filter the dates (keep correct matches)
-    cond1 = (pd.notna(dm.linkenddt) &
-             (dm['datadate'] >= dm.linkdt) & (dm['datadate'] <= dm.linkenddt))
-    cond2 = (pd.isna(dm.linkenddt) & (dm['datadate'] >= dm.linkdt))
-    dm = dm[cond1 | cond2]
-    # Rename lpermno to permno and remove unnecessary columns
-    dm = dm.rename(columns={'lpermno': 'permno'})
-    dm = dm[['gvkey', 'datadate', 'permno']]
-    # Check for duplicates on the key
-    n_dup = dm.shape[0] - dm[key].drop_duplicates().shape[0]
-    if n_dup > 0:
-        print("Warning: The merged permno",
-              "contains {:} duplicates".format(n_dup))
-    # Add the permno to the user's data
-    dfin = data[key].merge(dm, how='left', on=key)
-    dfin.index = index
-    return(dfin.permno)
-
-
-def merge_crsp_compustat(w, file_crsp, file_comp, link_table, columns,
-                         key=['gvkey', 'date', 'datadate']):
-
-    # Solution 1: let end user input the frequency of imported data
-    # Solution 2: check the frequency for imported data with code
-
-    # Add the necessary columns to process the data
-    # (permno, permco, link type, link primary)
-    cols_req = key + ['permno', 'permco', 'lpermco', 'lpermno',
-                      'linktype', 'linkprim']
-    cols = cols_req + list(set(columns) - set(cols_req))
-
-    # Open data
-    df_crsp = w.open_data(file_crsp, cols)
-    df_comp = w.open_data(file_comp, cols)
-    df_lt = w.open_data(link_table, cols)
-
-    # Extract year, month, day information
-    df_crsp['year'] = df_crsp['date'].dt.year
-    df_crsp['month'] = df_crsp['date'].dt.month
-    df_crsp['day'] = df_crsp['date'].dt.day
-
-    # Filter the linking table data
-    df_lt = df_lt[(df_lt.linktype == 'LC' or 'LU') &
-                  (df_lt.linkprim == 'P' or 'C')]
-
-    # Add GVKEY to CRSP monthly data using the linking table
-    df_lt_crsp = pd.merge(df_lt, df_crsp, left_on=['permco', 'permno'],
-                          right_on=['lpermco', 'lpermno'])
-
-    # Retain data within effective linking dates
-    df_lt_crsp = df_lt_crsp[(df_lt_crsp.date >= df_lt_crsp.linkdt) and
-                            (df_lt_crsp.date <= df_lt_crsp.linkenddt)]
-
-    # Add the return from CRSP processed data
-    # df_crsp = pd.merge(df_crsp, crsp_processed_ret, on=['permno','date']
-    # df_crsp = pd.merge(df_crsp, crsp_processed_stats_dsf,
-    #                    on=['permno','date'])
-
-    # Drop useless daily statistics (too specific!!)
-    # df_crsp.drop(columns = ['ret', 'vol', 'ask', 'bid', 'askhi', 'bidlo'])
-
-    # Merge CRSP data with GVKEY with Compustat data
-    df_ccm = pd.merge(df_comp, df_lt_crsp, how='right',
-                      left_on=['gvkey', 'datadate'],
-                      right_on=['gvkey', 'date'])
-
-    # Check for duplicates on the key
-    n_dup = df_ccm.shape[0] - df_ccm[key].drop_duplicates().shape[0]
-    if n_dup > 0:
-        print("Warning: The data contains {:} duplicates".format(n_dup))
+    link = link.rename(columns={'lpermno': 'permno'})
+    link = link[['gvkey', 'permno', 'linkdt', 'linkenddt']]
+    for c in ['linkdt', 'linkenddt']:
+        link[c] = pd.to_datetime(link[c], errors='coerce')
+    return(link.reset_index(drop=True))
+
+
+def gvkey_from_permno(w, data, link_table=None, linktype=['LC', 'LU'],
+                      linkprim=['P', 'C'], col_date='date'):
+    """ Returns COMPUSTAT gvkey from CRSP permno.
+    Arguments:
+        data -- User provided data.
+                Required columns: ['permno', 'col_date']
+        link_table --   WRDS provided linktable (ccmxpf_lnkhist)
+                        (the link table of the package if None)
+        linktype -- Default: [LC, LU]
+        linkprim -- Default: [P, C]
+        col_date -- Date column of the data.
+    """
+    dfu = w.open_data(data, ['permno', col_date])
+    index = link_index(w, link_table, linktype, linkprim, reverse=True)
+    gvkey, n = index.get(dfu.permno, dfu[col_date])
+    _check_links(n, 'gvkey')
+    return(gvkey)
+
+
+def permno_from_gvkey(w, data, link_table=None,
+                      linktype=['LC', 'LU'], linkprim=['P', 'C'],
+                      col_date='datadate'):
+    """ Returns CRSP permno from COMPUSTAT gvkey.
+    Arguments:
+        data -- User provided data.
+                Required columns: ['gvkey', 'col_date']
+        link_table --   WRDS provided linktable (ccmxpf_lnkhist)
+                        (the link table of the package if None)
+        linktype -- Default: [LC, LU]
+        linkprim -- Default: [P, C]
+        col_date -- Date column of the data.
+    """
+    dfu = w.open_data(data, ['gvkey', col_date])
+    index = link_index(w, link_table, linktype, linkprim)
+    permno, n = index.get(dfu.gvkey, dfu[col_date])
+    _check_links(n, 'permno')
+    return(permno)
+
 
-    return df_ccm
+def _check_links(n, description):
+    """ Print a message if several links are valid for some rows (the
+    earliest link is used).
+    """
+    n_dup = int((n > 1).sum())
+    if n_dup > 0:
+        print("Warning: The merged {} contains {:} duplicates".format(
+            description, n_dup))
+
+
+def merge_crsp_compustat(w, file_crsp, file_comp, fields_crsp, fields_comp,
+                         link_table=None, linktype=['LC', 'LU'],
+                         linkprim=['P', 'C'], lag=90, tolerance=None,
+                         filters_comp=None, name=None, processes=None):
+    """ Merge CRSP and COMPUSTAT data (CCM): attach to each CRSP
+    (permno, date) the latest COMPUSTAT fundamentals available at that
+    date for the gvkey linked to the permno at that date.
+    The fundamentals of a datadate are available from datadate + lag.
+    The data is processed by year of the CRSP dates, in parallel. Only
+    the CRSP rows of the year and the COMPUSTAT rows available during
+    the year (within the tolerance), with the latest earlier rows of the
+    linked gvkeys, are in memory (the earlier rows are found from the
+    gvkey and datadate columns).
+    Arguments:
+        file_crsp --    CRSP data (dsf, msf, ...).
+                        Required columns: [permno, date]
+        file_comp --    COMPUSTAT data (funda, fundq, ...).
+                        Required columns: [gvkey, datadate]
+        fields_crsp --  Fields of the CRSP data.
+        fields_comp --  Fields of the COMPUSTAT data.
+        link_table --   WRDS provided linktable (ccmxpf_lnkhist)
+                        (the link table of the package if None)
+        linktype -- Default: [LC, LU]
+        linkprim -- Default: [P, C]
+        lag --  Reporting lag (days or Timedelta). Default: 90 days.
+        tolerance --    Maximum age of the fundamentals after they are
+                        available (days or Timedelta). None for no limit.
+        filters_comp -- Filters of the COMPUSTAT data (see open_data), for
+                        instance {'indfmt': 'INDL', 'datafmt': 'STD',
+                        'consol': 'C', 'popsrc': 'D'}.
+        name -- If given, the merged data is written by year to the data
+                directory (as <name>.parquet, a dataset with one file
+                per year) and the name is returned. Otherwise the merged
+                data is returned (DataFrame).
+        processes --    Number of years processed at the same time
+                        (w.cores by default).
+    Return the columns [permno, date, gvkey, datadate] + fields_crsp +
+    fields_comp, by year (in the order of the CRSP data within a year).
+    """
+    lag = _timedelta(lag)
+    tolerance = _timedelta(tolerance)
+    # Years of the CRSP data (from the partitions or the parquet
+    # statistics of a converted file, without reading the dates)
+    if isinstance(file_crsp, str):
+        years = w.get_data_years(file_crsp, 'date')
+    else:
+        years = w.get_data_range(file_crsp, 'date')
+        if years is not None:
+            years = [pd.Timestamp(d).year for d in years]
+    years = [] if years is None else list(range(years[0], years[1]+1))
+    # Build the link index once (cached in the data directory for the
+    # other processes)
+    link_index(w, link_table, linktype, linkprim, reverse=True)
+    if name is not None:
+        w._check_data_dir()
+        path = w.datadir+name+'.parquet'
+        _remove_data(path)
+        os.makedirs(path)
+    args = [(year, file_crsp, file_comp, fields_crsp, fields_comp,
+             link_table, linktype, linkprim, lag, tolerance, filters_comp,
+             name) for year in years]
+    if processes is None:
+        processes = w.cores
+    processes = max(1, min(processes, len(years)))
+    if processes == 1 or not all(isinstance(f, str)
+                                 for f in [file_crsp, file_comp]):
+        dfs = [_merge_year(w, *a) for a in args]
+    else:
+        settings = {'date_type': w.date_type,
+                    'identifiers': w.identifiers,
+                    'parquet_options': w.parquet_options}
+        pool = mp.Pool(processes)
+        try:
+            dfs = pool.starmap(_merge_year_job,
+                               [(w.datadir, settings, a) for a in args])
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    if name is not None:
+        return(name)
+    cols = ['permno', 'date', 'gvkey', 'datadate']
+    cols += list(dict.fromkeys(fields_crsp + fields_comp))
+    if len(dfs) == 0:
+        return(pd.DataFrame(columns=cols))
+    return(pd.concat(dfs, ignore_index=True))
+
+
+def _merge_year_job(datadir, settings, args):
+    """ Merge a year of CRSP and COMPUSTAT data in a worker process (with
+    the settings of the wrds object).
+    """
+    w = wrds(datadir)
+    w.set_date_type(settings['date_type'])
+    w.set_identifiers(settings['identifiers'])
+    w.set_parquet_options(**settings['parquet_options'])
+    w.set_cache_size(0)
+    return(_merge_year(w, *args))
+
+
+def _merge_year(w, year, file_crsp, file_comp, fields_crsp, fields_comp,
+                link_table, linktype, linkprim, lag, tolerance,
+                filters_comp, name):
+    """ Merge the CRSP data of a year with the COMPUSTAT data (see
+    merge_crsp_compustat). Return the merged data or write it to the
+    dataset 'name' (and return None).
+    """
+    start = pd.Timestamp(year, 1, 1)
+    end = pd.Timestamp(year, 12, 31)
+    # CRSP data of the year with the linked gvkey
+    cols_crsp = list(dict.fromkeys(['permno', 'date'] + fields_crsp))
+    df = w.open_data(file_crsp, cols_crsp, filters={'date': (start, end)})
+    index = link_index(w, link_table, linktype, linkprim, reverse=True)
+    df['gvkey'], _ = index.get(df.permno, df.date)
+    # COMPUSTAT data available during the year
+    cols_comp = ['gvkey', 'datadate']
+    cols_comp += [f for f in fields_comp if f not in cols_comp+cols_crsp]
+    filters = dict(filters_comp or {})
+    if tolerance is None:
+        filters['datadate'] = (start-lag, end-lag)
+    else:
+        filters['datadate'] = (start-lag-tolerance, end-lag)
+    comp = w.open_data(file_comp, cols_comp, filters=filters)
+    if tolerance is None:
+        comp = pd.concat([_latest_before(w, file_comp, cols_comp,
+                                         filters_comp, df.gvkey,
+                                         start-lag), comp],
+                         ignore_index=True)
+    comp = comp.dropna(subset=['gvkey', 'datadate'])
+    comp['available'] = pd.to_datetime(comp.datadate) + lag
+    # Integer codes of the gvkeys (join key of the as-of join)
+    gvkeys = pd.Index(comp.gvkey.unique())
+    comp['__gvkey__'] = gvkeys.get_indexer(comp.gvkey)
+    comp = comp.drop(columns='gvkey')
+    comp = comp.sort_values('available', kind='mergesort')
+    # Latest fundamentals available at each date (as-of join by gvkey)
+    df['__row__'] = range(len(df))
+    df['__date__'] = pd.to_datetime(df.date)
+    df['__gvkey__'] = gvkeys.get_indexer(df.gvkey)
+    linked = df.gvkey.notna() & df.__date__.notna()
+    dm = pd.merge_asof(df[linked].sort_values('__date__'), comp,
+                       left_on='__date__', right_on='available',
+                       by='__gvkey__', direction='backward',
+                       tolerance=tolerance)
+    dm = pd.concat([dm, df[~linked]]).sort_values('__row__')
+    cols = ['permno', 'date', 'gvkey', 'datadate']
+    cols += list(dict.fromkeys(fields_crsp + fields_comp))
+    dm = dm[cols].reset_index(drop=True)
+    if name is None:
+        return(dm)
+    path = w.datadir+name+'.parquet'
+    t = pa.Table.from_pandas(dm, preserve_index=False)
+    pq.write_table(t, os.path.join(path, 'part-{}.parquet'.format(year)),
+                   **_parquet_options(t.schema, w._writer_options()))
+    return(None)
+
+
+def _latest_before(w, file_comp, cols_comp, filters_comp, gvkeys, date):
+    """ Return the latest COMPUSTAT rows of the gvkeys before a date (the
+    fundamentals still available at that date without tolerance).
+    The gvkey and datadate columns of the earlier rows are read first and
+    only the latest rows are read in full.
+    """
+    filters = dict(filters_comp or {})
+    gvkeys = pd.DataFrame({'gvkey': gvkeys.dropna().unique()})
+    if 'gvkey' in filters:
+        gvkeys = gvkeys[_filters_mask(gvkeys, {'gvkey': filters['gvkey']})]
+    filters['gvkey'] = gvkeys.gvkey.to_numpy()
+    filters['datadate'] = (None, date-pd.Timedelta(1, unit='D'))
+    keys = w.open_data(file_comp, ['gvkey', 'datadate'], filters=filters)
+    keys = keys.dropna().groupby('gvkey', observed=True).datadate.max()
+    filters['gvkey'] = keys.index.unique().to_numpy()
+    filters['datadate'] = keys.unique()
+    comp = w.open_data(file_comp, cols_comp, filters=filters)
+    latest = keys.reindex(comp.gvkey).to_numpy()
+    return(comp[comp.datadate.to_numpy() == latest])
+
+
+def _timedelta(x):
+    """ Return a duration (number of days or Timedelta) as a Timedelta. """
+    if x is None:
+        return(None)
+    if isinstance(x, (int, float, np.integer, np.floating)):
+        return(pd.Timedelta(x, unit='D'))
+    return(pd.Timedelta(x))
 
 
 def extract_ymd(df, date):
@@ -8,7 +8,8 @@ import pandas as pd
 # import numpy as np
 # from fuzzywuzzy import fuzz
 from rapidfuzz import fuzz
-from pywrds import wrds_module
+from pywrds import wrds_module, lookup
+from pywrds.pywrds import _filters_mask, _filters_key
 from pandas.tseries.offsets import MonthEnd
 
 
@@ -379,53 +380,110 @@ class ibes(wrds_module):
         dfin.index = dfu.index
         return(dfin.fpedats)
 
-    def _get_fields_det(self, fields=None):
-        """ Return the fields from the det file filtered. """
-        key = ['ticker', 'fpedats']
-        # Filter measure
-        det = self.w.open_data(self.det, ['measure'])
-        kmeasure = det.measure == self.measure
-        # Filter usfirm
-        det = self.w.open_data(self.det, ['usfirm'])
-        kusfirm = det.usfirm == self.usfirm
-        # Filter fpi
-        det = self.w.open_data(self.det, ['fpi'])
-        kfpi = det.fpi.isin(self.fpis)
-        # Filter pdf (Primary / Diluted)
-        if self.pdf == 'All':
-            kpdf = True
-        elif self.pdf == 'P' or self.pdf == 'D':
-            det = self.w.open_data(self.det, ['pdf'])
-            kpdf = det.pdf == self.pdf
-        elif self.pdf == 'DP':
-            det = self.w.open_data(self.det, key+['pdf'])
-            pdfd = det.pdf == 'D'
-            pdfp = det.pdf == 'P'
-            detk = det[key].drop_duplicates()
-            detd = det[pdfd].drop_duplicates()
-            detd = detd.rename({'pdf': 'pdfd'}, axis=1)
-            detp = det[pdfp].drop_duplicates()
-            detp = detp.rename({'pdf': 'pdfp'}, axis=1)
-            detk = detk.merge(detd, how='left', on=key)
-            detk = detk.merge(detp, how='left', on=key)
-            detk['PnotD'] = detk.pdfd.isna() & detk.pdfp.notna()
-            # Keep the observations where pdf=='D' and where the key is
-            # in detk[detk.PnotD]
-            indexdet = det.index
-            det = det.merge(detk[key+['PnotD']], how='left', on=key)
-            det.index = indexdet
-            kpdf = (det.pdf == 'D') | det.PnotD
-        # Create the final filter
-        mask = kmeasure & kusfirm & kfpi & kpdf
-        det = self.w.open_data(self.det, fields)
-        det = det[mask].drop_duplicates()
+    def _get_fields_det(self, fields=None, filters=None):
+        """ Return the fields from the det file filtered.
+        The filtered data is kept in the cache of the wrds object for each
+        selection (measure, usfirm, fpis and pdf) with the range of the
+        forecast periods read, and reused for the requests on a range
+        (and tickers) within it. Otherwise the det file is read again on
+        the union of the two ranges.
+        Arguments:
+            fields --   Fields from the det file.
+            filters --  Additional filters of the rows to read
+                        (for instance {'fpedats': (start, end)}).
+        """
+        if fields is None:
+            fields = self.w.get_fields_names(self.det)
+        ckey = (self.det, self.w.get_data_version(self.det), 'ibes.det',
+                self.w.date_type, self.w.identifiers, self.measure,
+                self.usfirm, tuple(self.fpis), self.pdf)
+        fkey = _filters_key(filters)
+        span = _fpedats_range(filters)
+        entry = self.w._cache_get(ckey)
+        cached = None
+        cols = list(fields)
+        scan = filters
+        if entry is not None:
+            data, covered, covered_span = entry
+            if covered == fkey:
+                cached = data
+            elif (span is not None and covered_span is not None and
+                    _range_contains(covered_span, span)):
+                # Filters on the key only (so that the 'DP' selection is
+                # the same) within the range read
+                cached = data[_filters_mask(data, filters)]
+            if cached is not None and not set(fields).issubset(
+                    cached.columns):
+                cached = None
+                span = _range_union(covered_span, span)
+                cols = list(data.columns) + fields
+            elif (cached is None and span is not None and
+                    covered_span is not None):
+                span = _range_union(covered_span, span)
+        if cached is None:
+            if span is not None and 'ticker' not in (filters or {}):
+                # Read the whole range of the forecast periods
+                cols = list(dict.fromkeys(cols + ['fpedats']))
+                scan = None
+                if span != (None, None):
+                    scan = {'fpedats': span}
+            else:
+                span = None
+            data = self._scan_det(cols, scan)
+            size = int(data.memory_usage(deep=True).sum())
+            self.w._cache_put(ckey, (data, _filters_key(scan), span), size)
+            cached = data
+            if scan is not filters:
+                cached = data[_filters_mask(data, filters or {})]
+        det = cached[fields].drop_duplicates()
         # Unadjust the values if needed (value, actual)
-        if fields is not None and self.unadjust:
+        if self.unadjust:
             for f in ['value', 'actual']:
                 if f in fields:
                     det[f] = self._unadjust([f], det)
         return(det)
 
+    def _scan_det(self, fields, filters=None):
+        """ Read the filtered fields from the det file in a single scan.
+        All the filters are evaluated batch by batch and only the
+        remaining rows are kept. When pdf='DP', the primary forecasts are
+        set aside during the scan and kept at the end only for the keys
+        without diluted forecasts.
+        """
+        key = ['ticker', 'fpedats']
+        fields = list(dict.fromkeys(fields))
+        # Filter measure, usfirm, fpi
+        filters = dict(filters or {})
+        filters.update({'measure': self.measure,
+                        'usfirm': self.usfirm,
+                        'fpi': self.fpis})
+        # Filter pdf (Primary / Diluted)
+        if self.pdf == 'P' or self.pdf == 'D':
+            filters['pdf'] = self.pdf
+        elif self.pdf == 'DP':
+            filters['pdf'] = ['D', 'P']
+        if self.pdf != 'DP':
+            dets = list(self.w.scan_data(self.det, fields, filters=filters))
+        else:
+            dets = []
+            detp = []
+            for det in self.w.scan_data(self.det, key+['pdf']+fields,
+                                        filters=filters):
+                dets += [det[det.pdf == 'D']]
+                detp += [det[det.pdf == 'P']]
+            # Keep the primary forecasts when there is no diluted forecast
+            # for the key
+            if len(detp) > 0:
+                detp = pd.concat(detp)
+                keysd = pd.MultiIndex.from_frame(
+                    pd.concat(dets)[key].drop_duplicates())
+                keysp = pd.MultiIndex.from_frame(detp[key])
+                dets += [detp[~keysp.isin(keysd)]]
+        if len(dets) == 0:
+            return(pd.DataFrame(columns=fields))
+        det = pd.concat(dets, ignore_index=True)
+        return(det[fields])
+
     def _get_fields_guidance(self, fields=None):
         """ Return the fields from the guidance file filtered. """
         cols = ['pdicity', 'measure', 'usfirm', 'units', 'prd_yr', 'prd_mon']
@@ -498,7 +556,7 @@ class ibes(wrds_module):
         # Compute the max fpedats (not available in guidance)
         df['ym'] = (df.prd_yr*100 + df.prd_mon).astype(int)
         df['fpedats_max'] = pd.to_datetime(df.ym, format='%Y%m') + MonthEnd()
-        df['fpedats_max'] = df.fpedats_max.dt.date
+        df['fpedats_max'] = self.w.to_dates(df.fpedats_max)
         # Keep the managements forecasts between EA(t-1) and FPE(t)
         df = df[(df.anndats >= df.eal1) & (df.anndats <= df.fpedats_max)]
         # Select the first or last MF if multiple
@@ -602,9 +660,8 @@ class ibes(wrds_module):
             dt = pd.to_datetime(ea.fpedats).dt
             ea['prd_yr'] = dt.year
             ea['prd_mon'] = dt.month
-        dfin = dfu.merge(ea[key+fields], how='left', on=key)
-        dfin.index = dfu.index
-        return(dfin[fields])
+        # Earnings annoucements with the same key (same time) are reported
+        return(lookup(dfu, ea, key, fields, duplicates='warn'))
 
     def get_ea_dates(self, data, shift=0, nadays=None):
         """ Return the earnings annoucement dates for a given
@@ -734,7 +791,14 @@ class ibes(wrds_module):
         """
         key = ['ticker', 'fpedats']
         cols = ['ticker', 'fpedats', 'analys', 'value', 'anndats', 'anntims']
-        det = self._get_fields_det(cols)
+        # Only read the forecast periods of the user data (and the
+        # following periods used for the consensus)
+        filters = None
+        dates = self.w.get_data_range(data, self.col_fpedats)
+        if dates is not None:
+            end = pd.Timestamp(dates[1]) + pd.DateOffset(years=for_quarter+1)
+            filters = {'fpedats': (dates[0], end)}
+        det = self._get_fields_det(cols, filters=filters)
         # # Get the adjustment factors
         # det['adj'] = self._get_adjustment_factors(det)
         # # Adjust the analyst forecasts
@@ -752,6 +816,24 @@ class ibes(wrds_module):
         # Add the fpedats for which the consensus should be computed
         cdt.loc[:, 'fpedats'] = cdt[self.col_fpedats]
         cdt = cdt.merge(fpec, how='left', on=['ticker', 'fpedats'])
+        if self.w.backend == 'duckdb':
+            c = self._consensus_sql(cdt, det, startdt, enddt, n, stat)
+        else:
+            c = self._consensus(cdt, det, startdt, enddt, n, stat)
+        # Add the consensus to the user data
+        key = ['ticker', 'fpedats']
+        dfu = self.w.open_data(data, ['ticker', self.col_fpedats])
+        dfu['fpedats'] = dfu[self.col_fpedats]
+        cons = dfu.merge(c[key+['consensus']], how='left', on=key)
+        cons.index = dfu.index
+        # Return the consensus
+        return(cons.consensus.astype('float32'))
+
+    def _consensus(self, cdt, det, startdt, enddt, n, stat):
+        """ Return the consensus of the last n analysts forecasts by
+        (ticker, fpedats, fpec) from the periods 'cdt' and the forecasts
+        'det' (see get_consensus).
+        """
         # Merge the datasets to compute the consensus
         det = det.rename({'fpedats': 'fpec'}, axis=1)
         key = ['ticker', 'fpec']
@@ -771,14 +853,35 @@ class ibes(wrds_module):
         g = df.groupby(key)
         c = fn(g['value']).reset_index()
         c = c.rename({'value': 'consensus'}, axis=1)
-        # Add the consensus to the user data
-        key = ['ticker', 'fpedats']
-        dfu = self.w.open_data(data, ['ticker', self.col_fpedats])
-        dfu['fpedats'] = dfu[self.col_fpedats]
-        cons = dfu.merge(c[key+['consensus']], how='left', on=key)
-        cons.index = dfu.index
-        # Return the consensus
-        return(cons.consensus.astype('float32'))
+        return(c)
+
+    def _consensus_sql(self, cdt, det, startdt, enddt, n, stat):
+        """ Return the consensus (see _consensus) computed with the SQL
+        engine (join, window and aggregation).
+        """
+        functions = {'mean': 'avg', 'median': 'median', 'min': 'min',
+                     'max': 'max', 'sum': 'sum', 'count': 'count',
+                     'std': 'stddev_samp', 'var': 'var_samp'}
+        if stat not in functions:
+            raise Exception("The statistic {} is not ".format(stat) +
+                            "available with the duckdb backend")
+        # Last n+1 forecasts by (ticker, fpec) in the periods
+        c = self.w.sql("""
+            SELECT ticker, fpedats, fpec, {fn}(value) AS consensus FROM (
+                SELECT c.ticker, c.fpedats, c.fpec, d.value,
+                    row_number() OVER (
+                        PARTITION BY c.ticker, c.fpec
+                        ORDER BY d.anntims IS NULL, d.anndats, d.anntims
+                    ) AS rn
+                FROM cdt c JOIN det d
+                ON c.ticker = d.ticker AND c.fpec = d.fpedats
+                WHERE d.anndats >= c."{start}" AND d.anndats <= c."{end}"
+            ) WHERE rn <= {n}
+            GROUP BY ticker, fpedats, fpec
+            """.format(fn=functions[stat], start=startdt, end=enddt, n=n+1),
+            cdt=cdt, det=det[['ticker', 'fpedats', 'value', 'anndats',
+                              'anntims']])
+        return(c)
 
     def get_ptg(self, data, startdt, enddt, measure='PTG',
                 horizon=12, n=5, stat='mean'):
@@ -803,23 +906,16 @@ class ibes(wrds_module):
                                                 amaskcd, anndats, anntims,
                                                 measure, usfirm]
         """
-        # Filter measure
+        # Filter measure, usfirm and horizon
         measures = ['PTG']
         if measure not in measures:
             raise Exception('Supported measures:', measures)
-        det = self.w.open_data(self.ptg, ['measure'])
-        kmeasure = det.measure == measure
-        # Filter usfirm
-        det = self.w.open_data(self.ptg, ['usfirm'])
-        kusfirm = det.usfirm == self.usfirm
-        # Filter horizon
-        det = self.w.open_data(self.ptg, ['horizon'])
-        khorizon = det.horizon == horizon
-        # Create the final filter
-        mask = kmeasure & kusfirm & khorizon
+        filters = {'measure': measure,
+                   'usfirm': self.usfirm,
+                   'horizon': horizon}
         cols = ['ticker', 'value', 'anndats', 'anntims', 'amaskcd']
-        det = self.w.open_data(self.ptg, cols)
-        det = det[mask].drop_duplicates()
+        det = self.w.open_data(self.ptg, cols, filters=filters)
+        det = det.drop_duplicates()
         # Create a full timestamp for the forecasts
         det.anntims = pd.to_timedelta(det.anntims, unit='s')
         det['time'] = pd.to_datetime(det.anndats) + det.anntims
@@ -856,7 +952,12 @@ class ibes(wrds_module):
     def get_numanalys(self, data):
         """ Return the number of analysts. """
         key = ['ticker', 'fpedats']
-        df = self._get_fields_det(key+['analys'])
+        # Only read the forecast periods of the user data
+        filters = None
+        dates = self.w.get_data_range(data, self.col_fpedats)
+        if dates is not None:
+            filters = {'fpedats': dates}
+        df = self._get_fields_det(key+['analys'], filters=filters)
         na = df.groupby(key).analys.nunique().reset_index(name='numanalys')
         # Merge to the user data
         dfu = self.w.open_data(data, ['ticker', self.col_fpedats])
@@ -871,6 +972,48 @@ class ibes(wrds_module):
 ##############
 
 
+def _fpedats_range(filters):
+    """ Return the range (start, end) of the forecast periods of filters
+    on the key (ticker, fpedats) of the det file ((None, None) when the
+    periods are not filtered), or None for other filters.
+    """
+    filters = filters or {}
+    if not set(filters).issubset(['ticker', 'fpedats']):
+        return(None)
+    value = filters.get('fpedats', (None, None))
+    if not isinstance(value, tuple):
+        return(None)
+    return(value)
+
+
+def _range_contains(a, b):
+    """ Return True if the range a (start, end) contains the range b
+    (None for no bound).
+    """
+    if a[0] is not None and (b[0] is None or
+                             pd.Timestamp(b[0]) < pd.Timestamp(a[0])):
+        return(False)
+    if a[1] is not None and (b[1] is None or
+                             pd.Timestamp(b[1]) > pd.Timestamp(a[1])):
+        return(False)
+    return(True)
+
+
+def _range_union(a, b):
+    """ Return the smallest range (start, end) containing the ranges a and
+    b (None for no bound, or for no range).
+    """
+    if a is None or b is None:
+        return(None)
+    start = None
+    if a[0] is not None and b[0] is not None:
+        start = min(pd.Timestamp(a[0]), pd.Timestamp(b[0]))
+    end = None
+    if a[1] is not None and b[1] is not None:
+        end = max(pd.Timestamp(a[1]), pd.Timestamp(b[1]))
+    return((start, end))
+
+
 def _adjustmentfactors(w, file_adj):
     """ Create an adjustment factor table with a start and end date
     for each factor."""
@@ -2,7 +2,7 @@
 Provides functions to compute several measures of th Implied Cost of Capital.
 """
 
-from pywrds import wrds_module
+from pywrds import wrds_module, lookup
 import pandas as pd
 import numpy as np
 from sklearn import linear_model
@@ -116,15 +116,11 @@ class icc(wrds_module):
         cc = pd.concat(pool.map(_get_root_ct, df_split))
         pool.close()
         pool.join()
-        # Create the dataset to merge with the user data
+        df['icc'] = cc
+        # Look up the cost of capital for the user data
         key = ['gvkey', 'datadate']
-        dfc = df[key]
-        dfc['icc'] = cc
-        # Merge with the user data
         dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(dfc, how='left', on=key)
-        dfin.index = dfu.index
-        return(dfin.icc.astype('float32'))
+        return(lookup(dfu, df, key, 'icc').astype('float32'))
 
     def hdz_gls(self, data, freq='Q', ind_vars=None):
         """ Compute the cost of capital of Gebhardt et al (2004) following
@@ -146,15 +142,11 @@ class icc(wrds_module):
         cc = pd.concat(pool.map(_get_root_gls, df_split))
         pool.close()
         pool.join()
-        # Create the dataset to merge with the user data
+        df['icc'] = cc
+        # Look up the cost of capital for the user data
         key = ['gvkey', 'datadate']
-        dfc = df[key]
-        dfc['icc'] = cc
-        # Merge with the user data
         dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(dfc, how='left', on=key)
-        dfin.index = dfu.index
-        return(dfin.icc.astype('float32'))
+        return(lookup(dfu, df, key, 'icc').astype('float32'))
 
     def hdz_gordon(self, data, freq='Q', ind_vars=None):
         """ Compute the cost of capital of Gordon and Gordon (1997) following
@@ -174,15 +166,11 @@ class icc(wrds_module):
         cc = pd.concat(pool.map(_get_root_gordon, df_split))
         pool.close()
         pool.join()
-        # Create the dataset to merge with the user data
+        df['icc'] = cc
+        # Look up the cost of capital for the user data
         key = ['gvkey', 'datadate']
-        dfc = df[key]
-        dfc['icc'] = cc
-        # Merge with the user data
         dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(dfc, how='left', on=key)
-        dfin.index = dfu.index
-        return(dfin.icc.astype('float32'))
+        return(lookup(dfu, df, key, 'icc').astype('float32'))
 
     def hdz_mpeg(self, data, freq='Q', ind_vars=None):
         """ Compute the cost of capital of Easton (2004) following
@@ -202,15 +190,11 @@ class icc(wrds_module):
         cc = pd.concat(pool.map(_get_root_mpeg, df_split))
         pool.close()
         pool.join()
-        # Create the dataset to merge with the user data
+        df['icc'] = cc
+        # Look up the cost of capital for the user data
         key = ['gvkey', 'datadate']
-        dfc = df[key]
-        dfc['icc'] = cc
-        # Merge with the user data
         dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(dfc, how='left', on=key)
-        dfin.index = dfu.index
-        return(dfin.icc.astype('float32'))
+        return(lookup(dfu, df, key, 'icc').astype('float32'))
 
     def hdz_oj(self, data, freq='Q', ind_vars=None):
         """ Compute the cost of capital of Ohlson and Juettner-Nauroth (2005)
@@ -234,13 +218,10 @@ class icc(wrds_module):
         df['A'] = 0.5 * ((df.gamma-1) + (df.D1/df.M))
         df['g'] = 0.5 * (((df.E3-df.E2)/df.E2) + ((df.E5-df.E4)/df.E4))
         df['icc'] = df.A + np.sqrt(df.A**2 + (df.E1/df.M)*(df.g-(df.gamma-1)))
-        # Create the dataset to merge with the user data
+        # Look up the cost of capital for the user data
         key = ['gvkey', 'datadate']
-        # Merge with the user data
         dfu = self.w.open_data(data, key)
-        dfin = dfu.merge(df[key+['icc']], how='left', on=key)
-        dfin.index = dfu.index
-        return(dfin.icc.astype('float32'))
+        return(lookup(dfu, df, key, 'icc').astype('float32'))
 
     def _earnings_forecasts_hdz(self, data, freq='Q', N=5, ind_vars=None):
         """ Compute the cost of capital
@@ -388,10 +369,8 @@ class icc(wrds_module):
         ###########################################
         # We now open the user data and append the ICC measure
         df = self.w.open_data(data, key)
-        index = df.index
         cols = ['E', 'B']
         for v in ['E', 'D', 'B', 'ROE']:
             cols += [v+str(i) for i in range(1, N+1)]
-        dfin = df.merge(dcf[key+cols], how='left', on=key)
-        dfin.index = index
-        return(dfin)
+        df[cols] = lookup(df, dcf, key, cols)
+        return(df)
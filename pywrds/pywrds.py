@@ -10,8 +10,22 @@ import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import dask.dataframe as dd
 import multiprocessing as mp
+import collections
+import shutil
+import datetime
+import csv
+import itertools
+import json
+import hashlib
+import base64
+import gzip
+import re
+import zipfile
 # Import pywrds modules
 # from .comp import comp
 
@@ -27,6 +41,21 @@ class wrds:
             self.set_data_directory(datadir)
         self.chunksize = 10000
         self.cores = mp.cpu_count()
+        self.date_type = 'date'
+        self.identifiers = None
+        self.parquet_options = {'compression': 'snappy',
+                                'compression_level': None,
+                                'row_group_size': None,
+                                'dictionary': True}
+        # Cache of the columns read from disk
+        # {(name, version, filters, column): (Series, size)}
+        self._cache = collections.OrderedDict()
+        self.cache_size = 2**30  # Bytes
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Engine of the heavy joins of the modules (see set_backend)
+        self.backend = 'pandas'
+        self._duckdb = None
         # Add the different modules
         from .comp import comp
         self.comp = comp(self)
@@ -53,6 +82,240 @@ class wrds:
     def set_chunksize(self, size):
         self.chunksize = size
 
+    def set_date_type(self, date_type):
+        """ Set the type of the date columns returned by open_data.
+        Arguments:
+            date_type --    'date' for Python dates (object columns) or
+                            'datetime64' for native datetime64[ns] columns.
+        The dates are stored as date32 in the converted files.
+        """
+        if date_type not in ['date', 'datetime64']:
+            raise Exception("The date type should be 'date' or 'datetime64'")
+        self.date_type = date_type
+
+    def to_dates(self, s):
+        """ Return the dates (Series) in the date type of the wrds object.
+        """
+        dates = pd.to_datetime(s)
+        if self.date_type == 'date':
+            return(dates.dt.date)
+        return(dates)
+
+    def set_parquet_options(self, compression=None, compression_level=None,
+                            row_group_size=None, dictionary=None):
+        """ Set the options of the parquet files written by convert_data
+        (the options not specified are unchanged). The files converted
+        with other options are converted again by convert_data.
+        Arguments:
+            compression --  Codec ('snappy', 'zstd', 'lz4', 'gzip',
+                            'brotli' or 'none').
+            compression_level --    Level of the codec (zstd, gzip, brotli).
+            row_group_size --   Number of rows of the row groups (the
+                                chunks converted are grouped). If None,
+                                one row group per chunk.
+            dictionary --   Dictionary encoding of the columns: True (all
+                            columns, with a fallback to plain encoding
+                            for large dictionaries), False or 'registry'
+                            (the low-cardinality columns listed under
+                            'dictionary' in the types files).
+        """
+        options = {'compression': compression,
+                   'compression_level': compression_level,
+                   'row_group_size': row_group_size,
+                   'dictionary': dictionary}
+        for k, v in options.items():
+            if v is not None:
+                self.parquet_options[k] = v
+        if self.parquet_options['dictionary'] not in [True, False,
+                                                      'registry']:
+            raise Exception("The dictionary encoding should be True, " +
+                            "False or 'registry'")
+
+    def _writer_options(self, types=None):
+        """ Return the options of the parquet writers. """
+        options = dict(self.parquet_options)
+        if options['dictionary'] == 'registry':
+            options['dictionary'] = _types_registry.get(types)['dictionary']
+        return(options)
+
+    def set_identifiers(self, mode):
+        """ Set the encoding of the identifiers (gvkey, permno, ticker,
+        cusip).
+        Arguments:
+            mode -- None: the identifiers are stored as is (default).
+                    'values': the identifiers are stored as int32 codes
+                    of dictionaries shared by all the files of the data
+                    directory and returned as values.
+                    'category': same storage, returned as categorical
+                    columns with the shared dictionaries as categories
+                    (merges on identifiers then run on the codes).
+                    Group by categorical columns with 'observed=True'.
+        The encoding applies to the files converted afterwards. The
+        encoded files are always decoded when read.
+        """
+        if mode not in [None, 'values', 'category']:
+            raise Exception("The identifiers mode should be None, " +
+                            "'values' or 'category'")
+        self.identifiers = mode
+
+    def _identifiers(self, dataset):
+        """ Return the dictionaries of the encoded identifiers of a
+        dataset {column: dictionary}.
+        """
+        return(_identifiers_registry.dictionaries(self.datadir, dataset))
+
+    def _to_pandas(self, t, identifiers):
+        """ Return the arrow table (or batch) as a pandas DataFrame
+        (identifiers decoded and dates in the date type).
+        """
+        t = _identifiers_registry.decode(t, identifiers,
+                                         self.identifiers == 'category')
+        df = t.to_pandas(date_as_object=(self.date_type == 'date'))
+        # Keep the nullable integers (instead of float)
+        ints = _types_registry.get()['ints']
+        for c in t.column_names:
+            if (c in ints and pa.types.is_integer(t.schema.field(c).type) and
+                    str(df[c].dtype) != ints[c]):
+                df[c] = df[c].astype(ints[c])
+        return(df)
+
+    def set_cache_size(self, size):
+        """ Set the maximum size (in bytes) of the data kept in memory
+        by open_data (0 to disable the cache).
+        """
+        self.cache_size = size
+        self._evict_cache()
+
+    def clear_cache(self):
+        """ Remove all the data kept in memory and reset the counters.
+        """
+        self._cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def cache_info(self):
+        """ Return the statistics of the cache.
+        """
+        return({'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'columns': len(self._cache),
+                'size': sum(n for _, n in self._cache.values()),
+                'maxsize': self.cache_size})
+
+    def _cache_get(self, key):
+        """ Return an entry of the cache (None if not in memory). """
+        if key not in self._cache:
+            self.cache_misses += 1
+            return(None)
+        self._cache.move_to_end(key)
+        self.cache_hits += 1
+        return(self._cache[key][0])
+
+    def _cache_put(self, key, value, size):
+        """ Keep an entry of 'size' bytes in the cache (if it fits). """
+        self._cache.pop(key, None)
+        if size <= self.cache_size:
+            self._cache[key] = (value, size)
+        self._evict_cache()
+
+    def _evict_cache(self, name=None):
+        """ Remove the least recently used columns above the cache size
+        (or all the columns of the data name).
+        """
+        if name is not None:
+            for k in [k for k in self._cache if k[0] == name]:
+                del self._cache[k]
+        size = sum(n for _, n in self._cache.values())
+        while size > self.cache_size and len(self._cache) > 0:
+            _, (_, n) = self._cache.popitem(last=False)
+            size -= n
+
+    def _open_data_cached(self, name, columns, filters):
+        """ Return the columns of the converted data using the cache.
+        Only the columns not in memory are read from disk.
+        """
+        base = (name, self.get_data_version(name), _filters_key(filters),
+                self.date_type, self.identifiers == 'category')
+        missing = []
+        for c in columns:
+            if base+(c,) in self._cache:
+                self._cache.move_to_end(base+(c,))
+                self.cache_hits += 1
+            else:
+                missing += [c]
+                self.cache_misses += 1
+        read = {}
+        if len(missing) > 0:
+            t, identifiers = self._read_table(name, missing, filters)
+            df = self._to_pandas(t, identifiers)
+            del(t)
+            for c in missing:
+                read[c] = df[c]
+                n = int(df[c].memory_usage(deep=True))
+                if n <= self.cache_size:
+                    self._cache[base+(c,)] = (df[c], n)
+            self._evict_cache()
+        data = {c: read[c] if c in read else self._cache[base+(c,)][0]
+                for c in columns}
+        return(pd.DataFrame(data, columns=columns, copy=True))
+
+    def _files_columns(self, name, columns=None):
+        """ Return the files of the converted data with their columns
+        {path: [columns]}: the converted file (or dataset) and the column
+        chunk files added afterwards (same rows in the same order).
+        If columns are given, only the files containing them are returned
+        (the unknown columns are attributed to the converted file).
+        """
+        filename_pq = self.datadir+name+'.parquet'
+        manifest = self.get_manifest(name) or {}
+        column_files = manifest.get('column_files') or {}
+        if columns is not None and len(column_files) == 0:
+            return({filename_pq: list(columns)})
+        files = {filename_pq: _dataset_columns(_dataset(filename_pq))}
+        for f, cols in column_files.items():
+            files[os.path.join(self.datadir+name+'.columns', f)] = cols
+        if columns is None:
+            return(files)
+        found = {}
+        for c in columns:
+            path = next((p for p, cols in files.items() if c in cols),
+                        filename_pq)
+            found.setdefault(path, []).append(c)
+        return(found)
+
+    def _read_table(self, name, columns, filters=None):
+        """ Return the columns of the converted data as an arrow table
+        (rows matching the filters) and the dictionaries of the encoded
+        identifiers.
+        The columns of the column chunk files are stitched together (by
+        position) before the filters are applied.
+        """
+        needed = list(dict.fromkeys(list(columns) + list(filters or {})))
+        files = self._files_columns(name, needed)
+        if len(files) == 1:
+            # Filters pushed down to the scan
+            dataset = _dataset(list(files)[0])
+            identifiers = self._identifiers(dataset)
+            expr = _filters_expression(dataset, filters, identifiers)
+            return(dataset.to_table(columns=columns, filter=expr),
+                   identifiers)
+        arrays = {}
+        identifiers = {}
+        for path, cols in files.items():
+            dataset = _dataset(path)
+            t = dataset.to_table(columns=cols)
+            if len(arrays) > 0 and t.num_rows != len(arrays[needed[0]]):
+                raise Exception(("The column files of {} do not have " +
+                                 "the same rows").format(name))
+            arrays.update(zip(cols, t.columns))
+            identifiers.update({c: d for c, d in
+                                self._identifiers(dataset).items()
+                                if c in cols})
+        arrays = {c: arrays[c] for c in needed}
+        dataset = ds.dataset(pa.table(arrays))
+        expr = _filters_expression(dataset, filters, identifiers)
+        return(dataset.to_table(columns=columns, filter=expr), identifiers)
+
     def set_data_directory(self, datadir):
         """ Defines the temporary data directory to store
         intermediate datasets.
@@ -64,83 +327,437 @@ class wrds:
         # Create the directory if it does not exist
         pathlib.Path(datadir).mkdir(parents=True, exist_ok=True)
 
-    def convert_data(self, filename, force=False, sample=None, types=None):
+    def convert_data(self, filename, force=False, sample=None, types=None,
+                     parallel=False, csv_engine='arrow', partition_on=None,
+                     incremental=False, checkpoint=None, columns=None):
         """ Convert the given file to arrow and save it in the
         data directory.
         Arguments:
-            filename -- Path of the file to convert.
-            force --    If False, the file is not converted if already done.
+            filename -- Path of the file to convert (.sas7bdat or .csv,
+                        possibly compressed: .gz or .zip archive of a
+                        single file, decompressed on the fly).
+            force --    If False, the file is not converted if already done
+                        from the same source content with the same
+                        types and options (see get_manifest).
             sample --   Integer. Only convert N observations.
+            types --    Path of a custom types file (yaml).
+            parallel -- If True, the chunks are decoded and type-corrected
+                        in a pool of 'self.cores' processes. The row
+                        groups are written in the order of the file.
+            csv_engine --   Reader to use for csv files. 'arrow' streams
+                            the file once with the multithreaded arrow
+                            reader (column types applied at parse time).
+                            'pandas' uses the pandas chunked reader.
+            partition_on -- Column used to write a hive-partitioned dataset
+                            (directory) instead of a single file
+                            (by default, the partitioning of the data
+                            already converted is kept).
+                            Date columns are partitioned by year
+                            (for instance 'date' for dsf, 'fpedats' for
+                            det_epsus), other columns by value
+                            (for instance 'fyear' for funda).
+            incremental --  If True, update a partitioned dataset with a new
+                            version of the file: only the partitions whose
+                            content changed are rewritten (the partitioning
+                            of the existing dataset is used by default).
+            checkpoint --   Number of rows after which the converted data
+                            is committed (part files). An interrupted
+                            conversion then resumes after the last
+                            committed rows when run again with a
+                            checkpoint. The converted data is a directory
+                            of part files. None to disable.
+            columns --  List of the columns to convert (None for all the
+                        columns). Only these columns are decoded and
+                        written. The columns missing from a converted
+                        file are added in a column chunk file
+                        (<name>.columns/) and read transparently by
+                        open_data. Without columns, the columns already
+                        converted are kept.
+        A manifest of the converted data is kept in the data directory
+        (see get_manifest).
         """
         self._check_data_dir()
         # Get the file type
-        name, ext = os.path.splitext(os.path.basename(filename))
+        name, ext, compression = _source_format(filename)
         # Create the new file name
         filename_pq = self.datadir+name+'.parquet'
-        # Check if the fle has already been converted
-        if os.path.exists(filename_pq) and force is False:
+        manifest = self.get_manifest(name) or {'version': 0}
+        source = _source_info(filename, manifest)
+        types_hash = _types_registry.get(types)['sha256']
+        # Keep the partitioning of the data by default
+        if partition_on is None:
+            partition_on = manifest.get('partition_on')
+        # Column chunk files (columns added to the converted file)
+        columns_path = self.datadir+name+'.columns'
+        if columns is not None:
+            columns = list(dict.fromkeys(c.lower() for c in columns))
+            if partition_on is not None and partition_on not in columns:
+                columns += [partition_on]
+        elif incremental:
+            # Keep the columns of the converted dataset
+            columns = manifest.get('columns')
+        # Check if the file has already been converted (same source content,
+        # types and options and complete output)
+        matched = force is False and _manifest_match(manifest, filename_pq,
+                                                     source, types_hash,
+                                                     sample, partition_on,
+                                                     columns_path,
+                                                     self.identifiers,
+                                                     self.parquet_options)
+        # Columns not converted yet
+        missing = []
+        if (matched and columns is not None and
+                manifest.get('columns') is not None):
+            converted = manifest['columns'] + [
+                c for v in manifest['column_files'].values() for c in v]
+            missing = [c for c in columns if c not in converted]
+        if matched and len(missing) == 0:
             # print("The file has already been converted. " +
             #       "Use force=True to force the conversion.")
-            None
+            if manifest['source_info'] != source:
+                manifest['source_info'] = source
+                _write_json(self._manifest_path(name), manifest)
         else:
-            # Open the file (by chunks)
+            # Converted file or column chunk file
+            target = filename_pq
+            if len(missing) > 0:
+                if manifest.get('partition_on') is not None:
+                    raise Exception("Columns can only be added to a " +
+                                    "converted file (not a partitioned " +
+                                    "dataset). Use force=True to convert " +
+                                    "the columns again.")
+                columns = missing
+                target = os.path.join(columns_path, 'part-{}.parquet'.format(
+                    len(manifest['column_files'])))
+                pathlib.Path(columns_path).mkdir(exist_ok=True)
+            elif incremental:
+                current = _partition_column(filename_pq)
+                if partition_on is None:
+                    partition_on = current
+                if partition_on is None:
+                    raise Exception("The incremental conversion requires " +
+                                    "a partitioned dataset (partition_on)")
+            # State of the conversion (saved at each checkpoint)
+            state = {'source_info': source,
+                     'types_sha256': types_hash,
+                     'sample': sample,
+                     'partition_on': partition_on,
+                     'identifiers': self.identifiers,
+                     'columns': columns,
+                     'schema': None,
+                     'parts': 0,
+                     'rows': 0}
+            if checkpoint is not None:
+                state = _checkpoint_state(target+'.checkpoint', state)
+            # Rows already converted and schema of an interrupted conversion
+            skip = state['rows']
+            schema = None
+            if state['schema'] is not None:
+                schema = _schema_from_str(state['schema'])
+            # Open the file (by chunks), decompressed on the fly
+            # The progress is given by the number of rows converted or the
+            # number of (compressed) bytes read.
+            if ext not in ['.sas7bdat', '.csv']:
+                raise Exception("This file format is not currently" +
+                                "supported. Supported formats are:" +
+                                ".sas7bdat, .csv (possibly compressed: " +
+                                ".gz, .zip)")
+            if ext == '.csv' and csv_engine not in ['arrow', 'pandas']:
+                raise Exception("'csv_engine' must be either 'arrow' " +
+                                "or 'pandas'")
+            # 'stream' is the file to read and 'raw' the file whose position
+            # gives the progress (None for the number of rows)
+            stream = filename
+            raw = None
+            names = None
+            if (compression == 'gzip' and ext == '.csv' and
+                    csv_engine == 'arrow'):
+                # Decompressed by arrow (the header is read separately)
+                with pa.CompressedInputStream(pa.OSFile(filename, 'rb'),
+                                              'gzip') as h:
+                    names = _csv_names(h)
+                raw = pa.OSFile(filename, 'rb')
+                stream = pa.CompressedInputStream(raw, 'gzip')
+            elif compression is not None:
+                stream, raw = _open_source(filename, compression)
+            elif ext == '.csv' and csv_engine == 'arrow':
+                stream = raw = pa.OSFile(filename, 'rb')
+            byte_columns = None
             if ext == '.sas7bdat':
-                f = pd.read_sas(filename, chunksize=self.chunksize)
+                f = pd.read_sas(stream, format='sas7bdat',
+                                chunksize=self.chunksize)
                 # Get the total number of rows
                 nrows = f.row_count
-            elif ext == '.csv':
-                f = pd.read_csv(filename, chunksize=self.chunksize)
-                # Get the total number of rows
-                # Need to open the file (only one column)
-                f_tmp = pd.read_csv(filename, usecols=[0])
-                nrows = f_tmp.shape[0]
-                del(f_tmp)
-            else:
-                raise Exception("This file format is not currently" +
-                                "supported. Supported formats are:" +
-                                ".sas7bdat, .csv")
+                # Get the string (bytes) columns from the SAS metadata
+                byte_columns = _sas_byte_columns(f)
+                # Skip the rows already converted
+                n = 0
+                while n < skip:
+                    df = f.read(min(self.chunksize, skip-n))
+                    if df is None or len(df) == 0:
+                        break
+                    n += len(df)
+            elif csv_engine == 'pandas':
+                usecols = None
+                if columns is not None:
+                    usecols = lambda c: c.lower() in columns  # noqa: E731
+                f = pd.read_csv(stream, chunksize=self.chunksize,
+                                skiprows=range(1, skip+1), usecols=usecols)
+                if raw is None:
+                    # Get the total number of rows
+                    # Need to open the file (only one column)
+                    f_tmp = pd.read_csv(filename, usecols=[0])
+                    nrows = f_tmp.shape[0]
+                    del(f_tmp)
+                byte_columns = []
             # Write the data
-            pqwriter = None
-            # pqschema = None
-            for i, df in enumerate(f):
-                df = self._process_fields(df)
-                df.columns = map(str.lower, df.columns)  # Lower case col names
-                df = correct_columns_types(df, types=types)
-                nobs = (i+1)*f.chunksize
-                print("Progress conversion {}: {:2.0%}".format(name,
-                      nobs/float(nrows)), end='\r')
-                if i == 0:
-                    # Correct the column types on the first chunk to get
-                    # the correct schema
-                    t = pa.Table.from_pandas(df)
-                    pqschema = t.schema
-                    pqwriter = pq.ParquetWriter(filename_pq, t.schema)
+            if ext == '.csv' and csv_engine == 'arrow':
+                chunks = _read_csv_arrow(stream, types=types, skip_rows=skip,
+                                         schema=schema, columns=columns,
+                                         names=names)
+            else:
+                chunks = self._convert_chunks(f, types=types,
+                                              parallel=parallel,
+                                              byte_columns=byte_columns,
+                                              schema=schema, columns=columns)
+            nbytes = os.path.getsize(filename)
+
+            def tables():
+                nobs = skip
+                for t in chunks:
+                    if sample is not None:
+                        if nobs >= sample:
+                            break
+                        t = t.slice(0, sample-nobs)
+                    if state['schema'] is None:
+                        absent = [c for c in columns or []
+                                  if c not in t.schema.names]
+                        if len(absent) > 0:
+                            raise Exception(("The columns {} are not in " +
+                                             "the file {}").format(absent,
+                                                                   filename))
+                        state['schema'] = _schema_to_str(t.schema)
+                    if self.identifiers is not None:
+                        t = _identifiers_registry.encode(self.datadir, t)
+                    yield t
+                    nobs += t.num_rows
+                    if raw is not None:
+                        progress = raw.tell()/float(max(nbytes, 1))
+                    else:
+                        progress = nobs/float(nrows)
+                    print("Progress conversion {}: {:2.0%}".format(name,
+                          progress), end='\r')
+
+            # The data is written to a temporary file or dataset which then
+            # replaces the previous data
+            options = self._writer_options(types)
+            if checkpoint is not None:
+                tmp = target+'.checkpoint'
+                self._write_checkpointed(tables(), tmp, partition_on,
+                                         checkpoint, state, options)
+            else:
+                tmp = target+'.tmp'+str(os.getpid())
+                _remove_data(tmp)
+                if partition_on is None:
+                    _write_file(tables(), tmp, options)
                 else:
-                    t = pa.Table.from_pandas(df, schema=pqschema)
-                    # t = pa.Table.from_pandas(df)
-                pqwriter.write_table(t)
-                if sample is not None and nobs > sample:
-                    break
+                    _write_partitioned(tables(), tmp, partition_on,
+                                       options=options)
+            changes = None
+            partitions = {}
+            if target != filename_pq:
+                # Column chunk file (same rows as the converted file)
+                _replace_data(tmp, target)
+                rows = sum(sum(v) for v in _data_layout(target).values())
+                if rows != manifest['rows']:
+                    _remove_data(target)
+                    raise Exception(("The rows of the columns {} do not " +
+                                     "match the converted file {}").format(
+                                         columns, name))
+            elif incremental:
+                # Only replace the partitions that changed
+                if current != partition_on:
+                    _remove_data(filename_pq)
+                partitions, changes = _merge_partitions(
+                    tmp, filename_pq, manifest.get('partitions'))
+                if sum(len(v) for v in changes.values()) > 0:
+                    self._evict_cache(name)
+            else:
+                if partition_on is not None:
+                    partitions = {p: None for p in _partitions(tmp)}
+                _replace_data(tmp, filename_pq)
+                _remove_data(columns_path)
+                self._evict_cache(name)
+            if checkpoint is not None:
+                os.remove(target+'.checkpoint.json')
+            # Save the manifest
+            if target != filename_pq:
+                manifest['version'] += 1
+                manifest['column_files'][os.path.basename(target)] = columns
+                _write_json(self._manifest_path(name), manifest)
+            else:
+                row_groups = _data_layout(filename_pq)
+                _write_json(self._manifest_path(name),
+                            {'version': manifest['version']+1,
+                             'source': os.path.abspath(filename),
+                             'source_info': source,
+                             'types_sha256': types_hash,
+                             'sample': sample,
+                             'identifiers': self.identifiers,
+                             'parquet_options': self.parquet_options,
+                             'partition_on': partition_on,
+                             'rows': sum(sum(v) for v in row_groups.values()),
+                             'row_groups': row_groups,
+                             'partitions': partitions,
+                             'changes': changes,
+                             'columns': columns,
+                             'column_files': {}})
+            # Save the new identifiers
+            _identifiers_registry.save(self.datadir)
+            chunks.close()
+            if raw is not None:
+                stream.close()
+                raw.close()
             print('\r')
-            pqwriter.close()
         return(name)
 
-    def _process_fields(self, df):
-        """ Properly encode the string fields (remove bytes string types) """
-        for c in df.columns:
-            if df[c].dtype == object:
-                df[c] = df[c].where(df[c].apply(type) != bytes,
-                                    df[c].str.decode('utf-8', errors='ignore'))
+    def convert_batch(self, files, processes=None, memory=None,
+                      force=False):
+        """ Convert a batch of files (largest first, in parallel within a
+        memory budget) and register them on their module
+        (see pywrds.batch.convert_batch).
+        """
+        from .batch import convert_batch
+        return(convert_batch(self, files, processes, memory, force))
+
+    def _write_checkpointed(self, tables, path, partition_on, rows, state,
+                            options=None):
+        """ Write arrow tables to part files of 'rows' rows (or a
+        partitioned dataset) and commit the state of the conversion after
+        each part in '<path>.json'.
+        """
+        tables = iter(tables)
+        t = next(tables, None)
+        while t is not None:
+            k = state['parts']
+            count = [0]
+
+            def part(t=t):
+                while t is not None:
+                    yield t
+                    count[0] += t.num_rows
+                    if count[0] >= rows:
+                        return
+                    t = next(tables, None)
+
+            if partition_on is None:
+                _write_file(part(), os.path.join(path,
+                                                  'part-{}.parquet'.format(k)),
+                            options)
+            else:
+                _write_partitioned(part(), path, partition_on,
+                                   'part-{}-{{i}}.parquet'.format(k),
+                                   options)
+            # Commit the part
+            _identifiers_registry.save(self.datadir)
+            state['parts'] = k+1
+            state['rows'] += count[0]
+            _write_json(path+'.json', state)
+            t = next(tables, None)
+
+    def _convert_chunks(self, f, types=None, parallel=False,
+                        byte_columns=None, schema=None, columns=None):
+        """ Generator of the chunks of the file 'f' converted to arrow
+        tables (in the order of the file).
+        Arguments:
+            f --    Iterator over the chunks of the file (pandas reader).
+            types --    Path of a custom types file (yaml).
+            parallel -- If True, process the chunks in a pool of
+                        'self.cores' processes.
+            byte_columns -- Columns of byte strings to decode. If None,
+                            they are detected on the first chunk.
+            schema --   Arrow schema of the tables. If None, it is
+                        defined by the first chunk.
+            columns --  Columns to convert (None for all the columns).
+        """
+        chunks = iter(f)
+        # The first chunk defines the schema of the file
+        df = next(chunks, None)
+        if df is None:
+            return
+        if byte_columns is None:
+            byte_columns = _byte_columns(_select_columns(df, columns))
+        df = _convert_chunk(df, types, byte_columns=byte_columns,
+                            columns=columns)
+        if schema is None:
+            schema = pa.Table.from_pandas(df).schema
+            # Use the known types (columns with only missing values in the
+            # first chunk would not have the correct type)
+            schema = _types_registry.arrow_schema(schema, types)
+        yield pa.Table.from_pandas(df, schema=schema)
+        if parallel and self.cores > 1:
+            pool = mp.Pool(self.cores)
+            try:
+                # Keep a limited number of chunks in the pool to
+                # bound the memory used
+                pending = collections.deque()
+                for df in chunks:
+                    pending.append(pool.apply_async(_convert_chunk,
+                                                    (df, types, schema,
+                                                     byte_columns, columns)))
+                    if len(pending) >= 2*self.cores:
+                        yield pending.popleft().get()
+                while len(pending) > 0:
+                    yield pending.popleft().get()
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for df in chunks:
+                yield _convert_chunk(df, types, schema, byte_columns,
+                                     columns)
+
+    @staticmethod
+    def _process_fields(df, byte_columns=None):
+        """ Properly encode the string fields (remove bytes string types)
+        Arguments:
+            df --   Raw data.
+            byte_columns -- Columns containing byte strings (for instance
+                            known from the SAS metadata). If None, the
+                            object columns are inspected.
+        """
+        if byte_columns is None:
+            byte_columns = _byte_columns(df)
+        byte_columns = [c for c in byte_columns if c in df.columns]
+        if len(byte_columns) > 0:
+            # Assign all the decoded columns at once (wide data)
+            decoded = {c: _decode_bytes(df[c]) for c in byte_columns}
+            df = pd.DataFrame({c: decoded.get(c, df[c]) for c in df.columns},
+                              index=df.index)
         return df
 
-    def open_data(self, name, columns=None, types=None, dask=False):
+    def open_data(self, name, columns=None, types=None, dask=False,
+                  filters=None):
         """ Open the data and return a pandas DataFrame.
         If a DataFrame is given, return the specified columns.
         If a string is given, return the converted data with the
         specifid columns.
+        Arguments:
+            filters --  Dictionary {column: filter} of the rows to read.
+                        The filter of a column is either
+                        a tuple (start, end) for a range (bounds included,
+                        None for no bound), a list for a membership or
+                        a value for an equality.
+                        The filters are pushed down to the Parquet scan
+                        (partitions and row groups statistics).
+        The columns read from disk are kept in memory (see set_cache_size
+        and clear_cache).
         """
         if isinstance(name, pd.DataFrame):
             # If the name refers to a pandas DataFrame, just return it
+            if filters is not None and len(filters) > 0:
+                name = name[_filters_mask(name, filters)]
             df = name[columns]
             # df = correct_columns_types(df, types)
         else:
@@ -149,12 +766,28 @@ class wrds:
             # Open the parquet file and convert it to a pandas DataFrame
             filename_pq = self.datadir+name+'.parquet'
             if dask:
+                files = self._files_columns(name, columns)
+                if len(files) > 1:
+                    raise Exception("The columns of several column files " +
+                                    "cannot be read with dask")
+                filename_pq = list(files)[0]
+                identifiers = self._identifiers(_dataset(filename_pq))
+                filters = _identifiers_registry.filters_codes(filters,
+                                                              identifiers)
                 df = dd.read_parquet(filename_pq, columns=columns,
-                                     engine='pyarrow')
+                                     engine='pyarrow',
+                                     filters=_filters_dnf(filters))
+                category = self.identifiers == 'category'
+                for c, d in identifiers.items():
+                    if c in df.columns:
+                        df[c] = df[c].map_partitions(_decode_codes,
+                                                     d.to_numpy(False),
+                                                     category)
             else:
-                t = pq.read_table(filename_pq, columns=columns)
-                df = t.to_pandas()
-                del(t)
+                if columns is None:
+                    columns = self.get_fields_names(name)
+                columns = list(dict.fromkeys(columns))  # Unique columns
+                df = self._open_data_cached(name, columns, filters)
         # df = df.drop_duplicates()
         return df
 
@@ -162,14 +795,238 @@ class wrds:
         if isinstance(name, pd.DataFrame):
             cols = name.columns
         else:
-            # Otherwise, open the file from disk
+            # Otherwise, open the file from disk (and the column files)
             self._check_data_dir()
-            # Open the parquet file and convert it to a pandas DataFrame
-            filename_pq = self.datadir+name+'.parquet'
-            schema = pq.read_schema(filename_pq)
-            cols = schema.names
+            cols = [c for v in self._files_columns(name).values() for c in v]
         return(cols)
 
+    def set_backend(self, backend):
+        """ Set the engine of the heavy joins, window functions and
+        aggregations of the modules:
+            'pandas' -- pandas merges (default).
+            'duckdb' -- Embedded columnar SQL engine (multi-core and
+                        out-of-core) running directly over the Parquet
+                        files of the data directory (requires the duckdb
+                        package).
+        """
+        if backend not in ['pandas', 'duckdb']:
+            raise Exception("The backend should be 'pandas' or 'duckdb'")
+        if backend == 'duckdb':
+            _import_duckdb()
+        self.backend = backend
+
+    def _duckdb_connection(self):
+        """ Return the connection to the embedded SQL engine (in memory,
+        spilled to the data directory).
+        """
+        if self._duckdb is None:
+            duckdb = _import_duckdb()
+            self._duckdb = duckdb.connect()
+            self._duckdb.execute("SET threads TO {}".format(self.cores))
+            self._duckdb.execute("SET temp_directory = '{}'".format(
+                _sql_str(self.datadir+'duckdb.tmp')))
+        return(self._duckdb)
+
+    def _duckdb_view(self, con, name):
+        """ Create the view of the converted data 'name' in the SQL
+        engine: the files (and column files) are read from disk and the
+        encoded identifiers are decoded.
+        """
+        relations = []
+        columns = []
+        identifiers = {}
+        for path, cols in self._files_columns(name).items():
+            dataset = _dataset(path)
+            if os.path.isdir(path) and len(_partitions(path)) > 0:
+                files = "read_parquet('{}/**/*.parquet', " \
+                        "hive_partitioning=true)".format(_sql_str(path))
+            else:
+                files = "read_parquet([{}])".format(
+                    ', '.join("'{}'".format(_sql_str(f))
+                              for f in dataset.files))
+            relations += ["(SELECT {} FROM {})".format(
+                ', '.join('"{}"'.format(c) for c in cols), files)]
+            columns += cols
+            identifiers.update({c: d for c, d in
+                                self._identifiers(dataset).items()
+                                if c in cols})
+        select = []
+        joins = ''
+        for c in columns:
+            if c in identifiers:
+                d = '__{}_{}'.format(name, c)
+                con.register(d, pa.table({
+                    'code': pa.array(np.arange(len(identifiers[c])),
+                                     pa.int32()),
+                    'value': identifiers[c]}))
+                select += ['"{}".value AS "{}"'.format(d, c)]
+                joins += ' LEFT JOIN "{0}" ON t."{1}" = "{0}".code'.format(
+                    d, c)
+            else:
+                select += ['t."{}"'.format(c)]
+        con.execute('CREATE OR REPLACE TEMP VIEW "{}" AS SELECT {} '
+                    'FROM ({}) t{}'.format(name, ', '.join(select),
+                                           ' POSITIONAL JOIN '.join(
+                                               relations), joins))
+
+    def sql(self, query, **tables):
+        """ Run a SQL query with the embedded engine (duckdb) and return
+        a pandas DataFrame.
+        The converted data of the data directory are available as views
+        (by name, for instance "dsf") and the DataFrames (or arrow tables)
+        given as keywords as tables (for instance sql(query, u=data)).
+        """
+        self._check_data_dir()
+        con = self._duckdb_connection()
+        names = [f[:-len('.parquet')] for f in os.listdir(self.datadir)
+                 if f.endswith('.parquet')]
+        try:
+            for k, t in tables.items():
+                if isinstance(t, pd.DataFrame):
+                    t = pa.Table.from_pandas(t, preserve_index=False)
+                con.register(k, t)
+            for name in names:
+                if (name not in tables and
+                        re.search(r'(?<![\w.]){}(?!\w)'.format(
+                            re.escape(name)), query)):
+                    self._duckdb_view(con, name)
+            t = con.execute(query).arrow()
+            if isinstance(t, pa.RecordBatchReader):
+                t = t.read_all()
+        finally:
+            for k in tables:
+                con.unregister(k)
+        return(self._to_pandas(t, {}))
+
+    def dataset(self, name, columns=None, filters=None):
+        """ Return a lazy handle on the converted data 'name' (or on a
+        DataFrame) with the given columns and filters (see open_data).
+        The column selections, filters and key joins of the handle are
+        only executed when the result is requested (see wrds_dataset).
+        """
+        return(wrds_dataset(self, name, columns, filters))
+
+    def scan_data(self, name, columns=None, filters=None):
+        """ Generator of the data read batch by batch (pandas DataFrames).
+        Only the rows matching the filters are returned (see open_data).
+        """
+        self._check_data_dir()
+        if columns is None:
+            columns = self.get_fields_names(name)
+        columns = list(dict.fromkeys(columns))  # Unique columns
+        needed = list(dict.fromkeys(columns + list(filters or {})))
+        files = self._files_columns(name, needed)
+        if len(files) > 1:
+            # Columns of several column files (read at once)
+            t, identifiers = self._read_table(name, columns, filters)
+            batches = t.to_batches(max_chunksize=self.chunksize)
+        else:
+            dataset = _dataset(list(files)[0])
+            identifiers = self._identifiers(dataset)
+            expr = _filters_expression(dataset, filters, identifiers)
+            batches = dataset.to_batches(columns=columns, filter=expr)
+        for b in batches:
+            if b.num_rows > 0:
+                yield self._to_pandas(b, identifiers)
+
+    def _manifest_path(self, name):
+        return(self.datadir+name+'.manifest.json')
+
+    def get_manifest(self, name):
+        """ Return the manifest of a converted file or dataset (None if
+        not available):
+            version --  Incremented at each conversion.
+            source --   Path of the source file.
+            source_info --  Size, modification time and content hash
+                            (sha256) of the source file.
+            types_sha256 -- Hash of the column types used.
+            sample --   Number of observations converted (None for all).
+            identifiers --  Encoding of the identifiers.
+            rows -- Number of rows.
+            row_groups --   Row groups of the files {file: [rows]}.
+            partition_on -- Partition column (None for a single file).
+            partitions --   Partitions {directory: content hash}
+                            (the hash is computed when first needed).
+            changes --  Partitions 'added', 'modified' and 'removed' by the
+                        last (incremental) conversion. None if all the
+                        data has been rewritten.
+            columns --  Columns converted (None for all the columns).
+            column_files -- Column chunk files added to the converted
+                            file {file: [columns]} (in <name>.columns/).
+        """
+        self._check_data_dir()
+        path = self._manifest_path(name)
+        if not os.path.exists(path):
+            return(None)
+        with open(path) as f:
+            return(json.load(f))
+
+    def get_data_version(self, name):
+        """ Return the version of a converted file or dataset
+        (to invalidate data derived from it).
+        """
+        self._check_data_dir()
+        filename_pq = self.datadir+name+'.parquet'
+        return(os.stat(filename_pq).st_mtime_ns)
+
+    def get_partition_keys(self, name):
+        """ Return the partition keys of a converted dataset
+        (empty if the data is a single file).
+        """
+        self._check_data_dir()
+        filename_pq = self.datadir+name+'.parquet'
+        return(list(_partition_keys(_dataset(filename_pq)).keys()))
+
+    def get_data_range(self, data, column):
+        """ Return the range (min, max) of a column of the data
+        (to be used as a filter on the WRDS data).
+        Return None if the column has no values.
+        """
+        s = self.open_data(data, [column])[column].dropna()
+        if len(s) == 0:
+            return(None)
+        return((s.min(), s.max()))
+
+    def get_data_years(self, name, column):
+        """ Return the range (first, last) of the years of a date column
+        of a converted file or dataset, from the year partition keys or
+        the parquet statistics of the row groups (the column is not read
+        unless some row groups have no statistics).
+        Return None if the column has no values.
+        """
+        self._check_data_dir()
+        dataset = _dataset(self.datadir+name+'.parquet')
+        keys = _partition_keys(dataset)
+        years = []
+        if keys.get(column+'_year') == column:
+            for f in dataset.get_fragments():
+                k = ds.get_partition_keys(f.partition_expression)
+                if k.get(column+'_year') is not None:
+                    years += [int(k[column+'_year'])]
+        else:
+            for f in dataset.get_fragments():
+                md = f.metadata
+                if column not in md.schema.names:
+                    continue
+                j = md.schema.names.index(column)
+                for i in range(md.num_row_groups):
+                    c = md.row_group(i).column(j)
+                    st = c.statistics
+                    if st is None or not st.has_min_max:
+                        if st is not None and st.null_count == c.num_values:
+                            continue
+                        # No statistics: read the column
+                        dates = self.get_data_range(name, column)
+                        if dates is None:
+                            return(None)
+                        return((pd.Timestamp(dates[0]).year,
+                                pd.Timestamp(dates[1]).year))
+                    years += [pd.Timestamp(st.min).year,
+                              pd.Timestamp(st.max).year]
+        if len(years) == 0:
+            return(None)
+        return((min(years), max(years)))
+
     def set_data_frequency(self, frequency):
         """ Define the frequency of the user's data """
         if frequency in ['Daily', 'daily', 'D', 'd']:
@@ -195,14 +1052,174 @@ class wrds:
         self.cores = cores
 
 
+class wrds_dataset:
+    """ Lazy handle on converted data (or a DataFrame) returned by
+    wrds.dataset. The column selections (select), filters (filter) and key
+    joins (join) are recorded and executed with the arrow dataset and
+    compute layer when the result is requested (to_table, to_pandas).
+    The keys of the data joined to converted data are pushed down as
+    filters on the scan (membership of the identifiers, range of the
+    dates) when the rows without a match are not returned, so that only
+    the needed rows and columns are read.
+    """
+
+    def __init__(self, w, name, columns=None, filters=None, joins=None):
+        self.w = w
+        self.name = name
+        self.columns = None if columns is None else list(columns)
+        self.filters = dict(filters or {})
+        self.joins = list(joins or [])
+
+    def _copy(self, **kwargs):
+        args = {'columns': self.columns, 'filters': self.filters,
+                'joins': self.joins}
+        args.update(kwargs)
+        return(wrds_dataset(self.w, self.name, **args))
+
+    def select(self, columns):
+        """ Return the handle with only the given columns. """
+        return(self._copy(columns=columns))
+
+    def filter(self, filters):
+        """ Return the handle with only the rows matching the filters
+        {column: filter} (in addition to the previous filters, see
+        open_data).
+        """
+        return(self._copy(filters=_filters_and(self.filters, filters)))
+
+    def join(self, other, on, how='left'):
+        """ Return the handle joined with other data on the keys 'on'.
+        Arguments:
+            other --    wrds_dataset, DataFrame or arrow table.
+            on --   Key columns.
+            how --  'left' (all the rows of the handle, in their order),
+                    'inner', 'semi' (rows of the handle with a match) or
+                    'anti' (rows of the handle without a match).
+        """
+        if how not in ['left', 'inner', 'semi', 'anti']:
+            raise Exception("The join should be 'left', 'inner', 'semi' " +
+                            "or 'anti'")
+        if not isinstance(other, wrds_dataset):
+            other = wrds_dataset(self.w, other)
+        on = [on] if isinstance(on, str) else list(on)
+        return(self._copy(joins=self.joins+[(other, on, how)]))
+
+    def _fields(self):
+        """ Return the columns of the data of the handle (before the
+        joins).
+        """
+        if isinstance(self.name, pd.DataFrame):
+            return(list(self.name.columns))
+        elif isinstance(self.name, pa.Table):
+            return(self.name.column_names)
+        return(list(self.w.get_fields_names(self.name)))
+
+    def _in_memory(self):
+        return(isinstance(self.name, (pd.DataFrame, pa.Table)))
+
+    def _execute(self, filters=None):
+        """ Return the result as an arrow table (identifiers decoded),
+        the positions of its rows in the DataFrame of the handle (None
+        otherwise) and the identifiers columns.
+        Arguments:
+            filters --  Additional filters on the data of the handle
+                        (keys of joined data).
+        """
+        fields = self._fields()
+        # The rows of joined data without a match are never returned:
+        # the keys of the handle are pushed down to the scan of the joined
+        # converted data. The inner and semi joins of converted data are
+        # executed first and their keys pushed down to the scan of the
+        # handle.
+        joined = {}
+        if not self._in_memory():
+            for i, (other, on, how) in enumerate(self.joins):
+                if how in ['inner', 'semi']:
+                    joined[i] = other._execute()
+                    filters = _filters_and(filters, _keys_filters(
+                        joined[i][0], [c for c in on if c in fields]))
+        filters = _filters_and(self.filters, filters)
+        columns = list(fields if self.columns is None else self.columns)
+        needed = list(dict.fromkeys(
+            [c for c in columns if c in fields] +
+            [c for _, on, _ in self.joins for c in on if c in fields]))
+        rows = None
+        identifiers = []
+        if isinstance(self.name, pd.DataFrame):
+            df = self.name
+            rows = np.arange(len(df))
+            if len(filters) > 0:
+                mask = _filters_mask(df, filters).values
+                df = df[mask]
+                rows = np.flatnonzero(mask)
+            t = pa.Table.from_pandas(df[needed], preserve_index=False)
+        elif isinstance(self.name, pa.Table):
+            t = self.name.select(needed)
+            expr = _filters_expression(ds.dataset(t), filters)
+            t = ds.dataset(t).to_table(filter=expr)
+        else:
+            t, ids = self.w._read_table(self.name, needed, filters)
+            t = _identifiers_registry.decode(t, ids)
+            identifiers = list(ids)
+        # Joins (in the order of the rows of the handle)
+        t = t.append_column('__row__', pa.array(np.arange(t.num_rows)))
+        for i, (other, on, how) in enumerate(self.joins):
+            if i not in joined:
+                keys = None
+                if not other._in_memory():
+                    keys = _keys_filters(t, [c for c in on
+                                             if c in other._fields()])
+                joined[i] = other._execute(keys)
+            o, _, ids = joined[i]
+            o = _cast_keys(o, t, on)
+            if how in ['semi', 'anti']:
+                o = o.select(on)
+            else:
+                o = o.select([c for c in o.column_names
+                              if c in on or c not in t.column_names])
+            t = t.join(o, on, join_type={'left': 'left outer',
+                                         'inner': 'inner',
+                                         'semi': 'left semi',
+                                         'anti': 'left anti'}[how])
+            identifiers += ids
+        t = t.sort_by('__row__')
+        if rows is not None:
+            rows = rows[t.column('__row__').to_numpy()]
+        t = t.drop(['__row__'])
+        if self.columns is not None:
+            t = t.select(self.columns)
+        return(t, rows, identifiers)
+
+    def to_table(self):
+        """ Execute the handle and return an arrow table. """
+        return(self._execute()[0])
+
+    def to_pandas(self):
+        """ Execute the handle and return a pandas DataFrame (with the
+        index of the DataFrame of the handle if any).
+        """
+        t, rows, identifiers = self._execute()
+        if self.w.identifiers == 'category':
+            for c in identifiers:
+                if c in t.column_names:
+                    i = t.column_names.index(c)
+                    t = t.set_column(i, c, pc.dictionary_encode(t.column(c)))
+        df = self.w._to_pandas(t, {})
+        if rows is not None:
+            df.index = self.name.index[rows]
+        return(df)
+
+
 class wrds_module:
 
     def __init__(self, w):
         # Link to the wrds object
         self.w = w
 
-    def add_file(self, name, path, force=False):
-        f = self.w.convert_data(path, force)
+    def add_file(self, name, path, force=False, incremental=False,
+                 columns=None):
+        f = self.w.convert_data(path, force, incremental=incremental,
+                                columns=columns)
         setattr(self, name, f)
 
     def get_lag(self, data, lag, fields=None, col_id=None, col_date=None):
@@ -245,58 +1262,1269 @@ def check_duplicates(df, key, description):
               duplicates".format(description, n_dup))
 
 
-def correct_columns_types(df, types=None):
-    """ Apply the correct data type to all known columns.
-    Known columns are listed in the files contained in the folder 'types'.
-    A custom type file can be provided by the user.
+class key_index:
+    """ Index of the keys of a reference table to look up the fields of
+    the rows of a user data (instead of merging the data with the table
+    and reindexing the result).
+    The keys are coded column by column (integer positions in the values
+    of the table) and combined into a single integer (sorted once).
+    Missing keys (NaN) never match.
+    Arguments:
+        table --    Reference table (DataFrame).
+        key --  Key columns of the table.
+        duplicates --   What to do with the rows of the table that have
+                        the same key: 'raise' (default, only when a key of
+                        the user data matches such rows), 'first' or
+                        'last' (keep the first or last row), 'warn' (keep
+                        the first row and print a message).
     """
-    types_dir = os.path.dirname(__file__)+'/types/'
 
-    def get_changes(path):
-        with open(path) as f:
-            t = yaml.full_load(f)
-            # Create the final type list
-            types_list1 = {}  # Convert to float before Int64
-            types_list2 = {}
+    def __init__(self, table, key, duplicates='raise'):
+        if duplicates not in ['raise', 'first', 'last', 'warn']:
+            raise Exception("Unknown duplicates policy {}".format(
+                duplicates))
+        if isinstance(key, str):
+            key = [key]
+        self.table = table
+        self.key = list(key)
+        self.values = []
+        codes = np.zeros(len(table), dtype='int64')
+        valid = np.ones(len(table), dtype=bool)
+        self.size = 1
+        for k in self.key:
+            c, values = pd.factorize(table[k])
+            self.values += [pd.Index(values)]
+            codes += c.astype('int64')*self.size
+            valid &= c >= 0
+            self.size *= max(len(values), 1)
+        if self.size >= 2**62:
+            raise Exception("Too many distinct keys to index")
+        self.duplicates = duplicates
+        # Positions of the rows with a (non missing) key, sorted by key
+        # (stable, so the rows of a same key stay in the table order)
+        rows = np.flatnonzero(valid)
+        codes = codes[valid]
+        order = np.argsort(codes, kind='stable')
+        codes = codes[order]
+        rows = rows[order]
+        # Bounds [start, end) of the rows of each distinct key
+        start = np.flatnonzero(np.r_[len(codes) > 0, codes[1:] != codes[:-1]])
+        end = np.r_[start[1:], len(codes)].astype(start.dtype)
+        n = end - start
+        self.n_dup = int(n[n > 1].sum())
+        if self.n_dup > 0 and duplicates == 'warn':
+            print("Warning: The keys {} of the table contain {} "
+                  "duplicates".format(self.key, self.n_dup))
+        self.codes = codes[start]
+        self.rows = rows[end-1] if duplicates == 'last' else rows[start]
+        # Distinct keys with several rows (checked at lookup)
+        self.dup = n > 1
+
+    def indexer(self, data, on=None):
+        """ Return the positions in the table of the rows of the data
+        (-1 when the key is not in the table).
+        Arguments:
+            data -- User data (DataFrame).
+            on --   Key columns of the data (the key of the table if None).
+        """
+        if on is None:
+            on = self.key
+        if isinstance(on, str):
+            on = [on]
+        codes = np.zeros(len(data), dtype='int64')
+        valid = np.ones(len(data), dtype=bool)
+        size = 1
+        for k, values in zip(on, self.values):
+            c = values.get_indexer(data[k])
+            codes += c.astype('int64')*size
+            valid &= c >= 0
+            size *= max(len(values), 1)
+        if len(self.codes) == 0:
+            return(np.full(len(data), -1, dtype='int64'))
+        pos = np.searchsorted(self.codes, codes)
+        pos = np.minimum(pos, len(self.codes)-1)
+        found = valid & (self.codes[pos] == codes)
+        if self.duplicates == 'raise' and self.n_dup > 0:
+            hit = found.copy()
+            hit[found] = self.dup[pos[found]]
+            if hit.any():
+                keys = data.loc[hit, on].drop_duplicates()
+                raise Exception(
+                    "The keys {} of the table are not unique for {} "
+                    "keys of the data: {}".format(
+                        self.key, len(keys),
+                        list(keys.head(5).itertuples(index=False,
+                                                     name=None))))
+        return(np.where(found, self.rows[pos], -1))
+
+    def get(self, data, fields, on=None):
+        """ Return the fields of the table for the rows of the data
+        (with the index of the data, missing values when the key is not
+        in the table). Only the requested columns are gathered.
+        Arguments:
+            data -- User data (DataFrame).
+            fields --   Fields of the table (list or single field).
+            on --   Key columns of the data (the key of the table if None).
+        """
+        pos = self.indexer(data, on)
+        if isinstance(fields, str):
+            return(_take(self.table[fields], pos, data.index))
+        return(pd.DataFrame({f: _take(self.table[f], pos, data.index)
+                             for f in fields}, index=data.index))
+
+
+def lookup(data, table, key, fields, on=None, duplicates='raise'):
+    """ Return the fields of a reference table for the rows of the data
+    (as a left merge on the key, with the index of the data and exactly
+    one row per row of the data).
+    Arguments:
+        data -- User data (DataFrame).
+        table --    Reference table (DataFrame).
+        key --  Key columns of the table.
+        fields --   Fields of the table (list or single field).
+        on --   Key columns of the data (same as key if None).
+        duplicates --   Duplicates policy of the table (see key_index).
+    """
+    return(key_index(table, key, duplicates).get(data, fields, on))
+
+
+def _take(s, pos, index):
+    """ Return the values of a Series at positions (missing values at
+    the positions -1) as a Series with the given index.
+    """
+    values = pd.api.extensions.take(s.array, pos, allow_fill=True)
+    return(pd.Series(values, index=index, name=s.name))
+
+
+class interval_index:
+    """ Index of values valid over date intervals by identifier (for
+    instance the permno linked to a gvkey between linkdt and linkenddt).
+    The intervals are sorted by identifier and start date and looked up
+    by binary search (no product of the data with the intervals).
+    Arguments:
+        df --   Intervals (DataFrame).
+        id --   Identifier column.
+        start --    Start date column (included).
+        end --  End date column (included, missing for no end).
+        value --    Value column.
+    """
+
+    def __init__(self, df, id, start, end, value):
+        df = df[[id, start, end, value]].dropna(subset=[id, start, value])
+        df = df.sort_values([id, start], kind='mergesort')
+        self.df = df.reset_index(drop=True)
+        self.columns = (id, start, end, value)
+        self.codes, keys = pd.factorize(self.df[id], sort=True)
+        self.keys = pd.Index(keys)
+        self.starts = _days(self.df[start])
+        ends = _days(self.df[end])
+        ends[pd.isna(self.df[end]).to_numpy()] = np.iinfo('int64').max
+        self.ends = ends
+        if len(self.df) > 0:
+            self.origin = self.starts.min()
+            self.span = int(self.starts.max() - self.origin) + 2
+        else:
+            self.origin, self.span = 0, 1
+        # Composite sorted key (identifier, start)
+        self.sorted = self.codes*self.span + (self.starts-self.origin)
+        # Number of preceding intervals to check when intervals of an
+        # identifier overlap
+        self.depth = 1
+        k = 1
+        while k < len(self.df):
+            same = self.codes[k:] == self.codes[:-k]
+            if not same.any():
+                break
+            if (same & (self.ends[:-k] >= self.starts[k:])).any():
+                self.depth = k+1
+            k += 1
+
+    def indexer(self, ids, dates):
+        """ Return the positions (in self.df) of the interval valid at
+        each date for each identifier (-1 if none, the earliest interval
+        if several) and the number of valid intervals.
+        Arguments:
+            ids --  Identifiers (Series).
+            dates --    Dates (Series).
+        """
+        ids = pd.Series(ids)
+        if (pd.api.types.is_numeric_dtype(self.keys) and
+                not pd.api.types.is_numeric_dtype(ids)):
+            ids = pd.to_numeric(ids, errors='coerce')
+        codes = self.keys.get_indexer(ids)
+        days = _days(dates)
+        valid = (codes >= 0) & pd.notna(pd.Series(dates)).to_numpy()
+        rel = np.clip(days-self.origin, -1, self.span-1)
+        target = codes*self.span + rel
+        cand = np.searchsorted(self.sorted, target, side='right') - 1
+        pos = np.full(len(codes), -1, dtype='int64')
+        count = np.zeros(len(codes), dtype='int64')
+        for j in range(self.depth):
+            p = cand - j
+            ok = valid & (p >= 0)
+            p = np.where(ok, p, 0)
+            ok &= (self.codes[p] == codes) & (self.ends[p] >= days)
+            # The earliest interval is kept
+            pos[ok] = p[ok]
+            count += ok
+        return(pos, count)
+
+    def get(self, ids, dates, index=None):
+        """ Return the values valid at each date for each identifier
+        (missing if none) and the number of valid intervals.
+        Arguments:
+            ids --  Identifiers (Series).
+            dates --    Dates (Series).
+            index --    Index of the values returned (the index of ids
+                        if None).
+        """
+        pos, count = self.indexer(ids, dates)
+        if index is None:
+            index = pd.Series(ids).index
+        return(_take(self.df[self.columns[3]], pos, index), count)
+
+
+def _days(dates):
+    """ Return the dates as numbers of days (int64, undefined for missing
+    dates).
+    """
+    dates = pd.to_datetime(pd.Series(dates), errors='coerce').to_numpy()
+    return(dates.astype('datetime64[D]').astype('int64'))
+
+
+def _convert_chunk(df, types=None, schema=None, byte_columns=None,
+                   columns=None):
+    """ Prepare a chunk of raw data and return it as an arrow table.
+    Defined globally to be used in parallel conversions.
+    Arguments:
+        df --   Chunk of raw data (pandas DataFrame).
+        types --    Path of a custom types file (yaml).
+        schema --   Arrow schema of the converted file. If None, return
+                    the DataFrame (used to infer the schema).
+        byte_columns -- Columns of byte strings to decode.
+        columns --  Columns to convert (None for all the columns).
+    """
+    df = _select_columns(df, columns)
+    df = wrds._process_fields(df, byte_columns)
+    df.columns = map(str.lower, df.columns)  # Lower case col names
+    # The dates are kept as datetime64 (stored as date32 by the schema)
+    df = correct_columns_types(df, types=types, date_type='datetime64')
+    if schema is None:
+        return(df)
+    return(pa.Table.from_pandas(df, schema=schema))
+
+
+def _select_columns(df, columns=None):
+    """ Return the columns of the raw data to convert (lower case names
+    in 'columns', all the columns if None).
+    """
+    if columns is None:
+        return(df)
+    return(df[[c for c in df.columns if c.lower() in columns]])
+
+
+def _source_format(path):
+    """ Return the name, the format (extension) and the compression
+    ('gzip', 'zip' or None) of a source file. For instance 'funda',
+    '.sas7bdat' and 'gzip' for funda.sas7bdat.gz.
+    The format of a zip archive is the format of its file.
+    """
+    name, ext = os.path.splitext(os.path.basename(path))
+    compression = {'.gz': 'gzip', '.zip': 'zip'}.get(ext.lower())
+    if compression == 'gzip':
+        name, ext = os.path.splitext(name)
+    elif compression == 'zip':
+        ext = os.path.splitext(_zip_member(path))[1]
+        name = os.path.splitext(name)[0] if name.endswith(ext) else name
+    return(name, ext.lower(), compression)
+
+
+def _zip_member(path):
+    """ Return the name of the file of a zip archive (single file). """
+    with zipfile.ZipFile(path) as z:
+        files = [i.filename for i in z.infolist() if not i.is_dir()]
+    if len(files) != 1:
+        raise Exception(("The zip archive {} should contain a " +
+                         "single file").format(path))
+    return(files[0])
+
+
+def _open_source(path, compression):
+    """ Return a compressed source file decompressed on the fly (binary
+    file) and the underlying compressed file (its position is the number
+    of compressed bytes read).
+    """
+    raw = open(path, 'rb')
+    if compression == 'gzip':
+        return(gzip.GzipFile(fileobj=raw), raw)
+    z = zipfile.ZipFile(raw)
+    return(z.open(_zip_member(path)), raw)
+
+
+def _sas_byte_columns(f):
+    """ Return the string columns of a SAS file from its metadata
+    (pandas SAS7BDAT reader). These columns are read as byte strings.
+    Return None if the metadata is not available.
+    """
+    ctypes = getattr(f, '_column_types', None)
+    names = getattr(f, 'column_names', None)
+    if ctypes is None or names is None:
+        return(None)
+    return([n for n, t in zip(names, ctypes) if t == b's'])
+
+
+def _byte_columns(df):
+    """ Return the object columns of the data that contain byte strings
+    (based on the first non-missing value of each column).
+    """
+    cols = []
+    for c in df.columns:
+        if df[c].dtype == object:
+            i = df[c].first_valid_index()
+            if i is not None and isinstance(df[c].loc[i], bytes):
+                cols += [c]
+    return(cols)
+
+
+def _decode_bytes(s):
+    """ Decode a Series of byte strings (utf-8, invalid bytes are ignored).
+    Each distinct value is decoded only once and the decoded values are
+    gathered with numpy. Missing values are kept.
+    """
+    codes, uniques = pd.factorize(s.values)
+    decoded = [u.decode('utf-8', errors='ignore') if isinstance(u, bytes)
+               else u for u in uniques]
+    decoded = np.array(decoded + [np.nan], dtype=object)
+    # Missing values have code -1 (last element)
+    return(pd.Series(decoded[codes], index=s.index, name=s.name))
+
+
+def _remove_data(path):
+    """ Remove a converted file or dataset (directory). """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _write_json(path, content):
+    """ Write the content to a json file atomically. """
+    with open(path+'.tmp', 'w') as f:
+        json.dump(content, f, indent=1, default=str)
+    os.replace(path+'.tmp', path)
+
+
+def _file_hash(path):
+    """ Return the content hash (sha256) of a file. """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            h.update(block)
+    return(h.hexdigest())
+
+
+def _source_info(path, manifest=None):
+    """ Return the size, modification time and content hash of a source
+    file. The hash of the manifest is reused if the size and modification
+    time did not change.
+    """
+    st = os.stat(path)
+    info = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    old = (manifest or {}).get('source_info') or {}
+    if (old.get('size') == info['size'] and
+            old.get('mtime') == info['mtime'] and 'sha256' in old):
+        info['sha256'] = old['sha256']
+    else:
+        info['sha256'] = _file_hash(path)
+    return(info)
+
+
+def _data_layout(path):
+    """ Return the row groups (number of rows) of the files of a
+    converted file or dataset {file: [rows]}.
+    """
+    if os.path.isfile(path):
+        files = {'.': path}
+    else:
+        files = {os.path.relpath(os.path.join(r, f), path):
+                 os.path.join(r, f)
+                 for r, _, fs in os.walk(path) for f in fs}
+    layout = {}
+    for k in sorted(files):
+        md = pq.read_metadata(files[k])
+        layout[k] = [md.row_group(i).num_rows
+                     for i in range(md.num_row_groups)]
+    return(layout)
+
+
+def _manifest_match(manifest, path, source, types_hash, sample,
+                    partition_on=None, columns_path=None, identifiers=None,
+                    parquet_options=None):
+    """ Return True if the converted data matches its manifest: same source
+    content, types, sample, encoding of the identifiers and parquet
+    options (and partitioning if given) and the files
+    with the recorded row groups (and the column chunk files in
+    'columns_path' with the same number of rows).
+    """
+    if not os.path.exists(path):
+        return(False)
+    old = manifest.get('source_info') or {}
+    if (old.get('size') != source['size'] or
+            old.get('sha256') != source['sha256'] or
+            manifest.get('types_sha256') != types_hash or
+            manifest.get('sample') != sample or
+            manifest.get('identifiers') != identifiers or
+            manifest.get('parquet_options') != parquet_options):
+        return(False)
+    if (partition_on is not None and
+            manifest.get('partition_on') != partition_on):
+        return(False)
+    try:
+        layout = _data_layout(path)
+        for f in (manifest.get('column_files') or {}):
+            if columns_path is None:
+                break
+            rows = _data_layout(os.path.join(columns_path, f)).values()
+            if sum(sum(v) for v in rows) != manifest.get('rows'):
+                return(False)
+    except Exception:
+        # Missing or incomplete file
+        return(False)
+    return(layout == manifest.get('row_groups'))
+
+
+def _replace_data(tmp, path):
+    """ Replace a converted file or dataset by a temporary one. """
+    if os.path.exists(path) and (os.path.isdir(path) or os.path.isdir(tmp)):
+        old = path+'.old'+str(os.getpid())
+        os.replace(path, old)
+        os.replace(tmp, path)
+        _remove_data(old)
+    else:
+        os.replace(tmp, path)
+
+
+def _partition_column(path):
+    """ Return the partition column of a converted dataset (None if not
+    partitioned).
+    """
+    if not os.path.isdir(path):
+        return(None)
+    keys = list(_partition_keys(_dataset(path)).values())
+    return(keys[0] if len(keys) > 0 else None)
+
+
+def _partitions(path):
+    """ Return the partitions (relative directories containing files) of
+    a hive-partitioned dataset.
+    """
+    partitions = []
+    for root, dirs, files in os.walk(path):
+        if root != path and len(files) > 0:
+            partitions += [os.path.relpath(root, path)]
+    return(sorted(partitions))
+
+
+def _partition_hash(path):
+    """ Return the hash of the content of a partition (rows in the order
+    of the files), independent of the layout of the files.
+    """
+    files = sorted(os.listdir(path),
+                   key=lambda f: (len(f), f))  # part-2 before part-10
+    h = hashlib.sha256()
+    for f in files:
+        t = pq.read_table(os.path.join(path, f))
+        h.update(str(t.schema.remove_metadata()).encode())
+        df = t.to_pandas()
+        h.update(pd.util.hash_pandas_object(df, index=False).values)
+    return(h.hexdigest())
+
+
+def _merge_partitions(staging, path, hashes=None):
+    """ Replace the partitions of the dataset 'path' by the partitions of
+    the dataset 'staging' with a different content. The unchanged
+    partitions are not modified and the staging dataset is removed.
+    Return the hashes of the partitions {partition: hash} and the changes
+    {'added': [...], 'modified': [...], 'removed': [...]}.
+    Arguments:
+        hashes --   Known hashes of the partitions of 'path'.
+    """
+    hashes = dict(hashes or {})
+    if os.path.isfile(path):
+        os.remove(path)
+    old = _partitions(path) if os.path.isdir(path) else []
+    new = _partitions(staging)
+    partitions = {}
+    changes = {'added': [], 'modified': [], 'removed': []}
+    for p in new:
+        h = _partition_hash(os.path.join(staging, p))
+        if p in old:
+            if hashes.get(p) is None:
+                hashes[p] = _partition_hash(os.path.join(path, p))
+            if hashes[p] == h:
+                partitions[p] = h
+                continue
+            shutil.rmtree(os.path.join(path, p))
+            changes['modified'] += [p]
+        else:
+            changes['added'] += [p]
+        pathlib.Path(os.path.join(path, p)).parent.mkdir(parents=True,
+                                                         exist_ok=True)
+        os.replace(os.path.join(staging, p), os.path.join(path, p))
+        partitions[p] = h
+    for p in old:
+        if p not in new:
+            shutil.rmtree(os.path.join(path, p))
+            changes['removed'] += [p]
+    shutil.rmtree(staging)
+    return(partitions, changes)
+
+
+def _partition_key(schema, column):
+    """ Return the partition key of a column: '<column>_year' for dates
+    (partitioned by year), the column itself otherwise.
+    """
+    t = schema.field(column).type
+    if pa.types.is_date(t) or pa.types.is_timestamp(t):
+        return(column+'_year')
+    return(column)
+
+
+def _parquet_options(schema, options=None):
+    """ Return the arguments of the parquet writer (codec and dictionary
+    encoding) given the options (see wrds.set_parquet_options).
+    """
+    options = options or {}
+    dictionary = options.get('dictionary', True)
+    if not isinstance(dictionary, bool):
+        dictionary = [c for c in schema.names if c in dictionary]
+    compression = options.get('compression', 'snappy')
+    return({'compression': 'NONE' if compression == 'none' else compression,
+            'compression_level': options.get('compression_level'),
+            'use_dictionary': dictionary})
+
+
+def _write_file(tables, path, options=None):
+    """ Write arrow tables (same schema) to a parquet file.
+    Arguments:
+        options --  Options of the file (see wrds.set_parquet_options).
+    """
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    size = (options or {}).get('row_group_size')
+    pqwriter = None
+    rows = []   # Rows not written yet (row groups of 'size' rows)
+    n = 0
+    for t in tables:
+        if pqwriter is None:
+            pqwriter = pq.ParquetWriter(path, t.schema,
+                                        **_parquet_options(t.schema, options))
+        if size is None:
+            pqwriter.write_table(t)
+            continue
+        rows += [t]
+        n += t.num_rows
+        if n >= size:
+            t = pa.concat_tables(rows)
+            pqwriter.write_table(t.slice(0, n - n % size),
+                                 row_group_size=size)
+            rows = [t.slice(n - n % size)]
+            n = n % size
+    if pqwriter is not None:
+        if n > 0:
+            pqwriter.write_table(pa.concat_tables(rows), row_group_size=size)
+        pqwriter.close()
+
+
+def _schema_to_str(schema):
+    """ Return an arrow schema serialized as a string. """
+    return(base64.b64encode(schema.serialize().to_pybytes()).decode())
+
+
+def _schema_from_str(schema):
+    """ Return the arrow schema serialized with _schema_to_str. """
+    return(pa.ipc.read_schema(pa.py_buffer(base64.b64decode(schema))))
+
+
+def _checkpoint_state(path, state):
+    """ Return the state of an interrupted conversion to resume (saved in
+    '<path>.json') if it has the same source, types and options as the
+    new state. The uncommitted part files are removed. Otherwise, remove
+    the previous conversion and return the new state.
+    """
+    old = None
+    if os.path.exists(path+'.json'):
+        with open(path+'.json') as f:
+            old = json.load(f)
+    keys = ['source_info', 'types_sha256', 'sample', 'partition_on',
+            'identifiers', 'columns']
+    if (old is None or not os.path.isdir(path) or
+            any(old.get(k) != state[k] for k in keys if k != 'source_info') or
+            old['source_info']['sha256'] != state['source_info']['sha256']):
+        _remove_data(path)
+        _remove_data(path+'.json')
+        return(state)
+    for root, _, files in os.walk(path):
+        for f in files:
+            if int(f.split('-')[1].split('.')[0]) >= old['parts']:
+                os.remove(os.path.join(root, f))
+    old['source_info'] = state['source_info']
+    return(old)
+
+
+def _write_partitioned(tables, path, column, basename='part-{i}.parquet',
+                       options=None):
+    """ Write arrow tables to a hive-partitioned dataset (directory)
+    partitioned on the given column.
+    Arguments:
+        tables --   Iterator of arrow tables (same schema).
+        path -- Directory of the dataset.
+        column --   Partition column (dates are partitioned by year).
+        basename -- Template of the names of the files.
+        options --  Options of the files (see wrds.set_parquet_options).
+    """
+    tables = iter(tables)
+    first = next(tables, None)
+    if first is None:
+        return
+    key = _partition_key(first.schema, column)
+
+    def batches():
+        for t in itertools.chain([first], tables):
+            if key != column:
+                year = pc.year(t.column(column)).cast(pa.int32())
+                t = t.append_column(key, year)
+            for b in t.to_batches():
+                yield b
+
+    schema = first.schema
+    if key != column:
+        schema = schema.append(pa.field(key, pa.int32()))
+    partitioning = ds.partitioning(pa.schema([schema.field(key)]),
+                                   flavor='hive')
+    file_options = ds.ParquetFileFormat().make_write_options(
+        **_parquet_options(schema, options))
+    groups = {}
+    size = (options or {}).get('row_group_size')
+    if size is not None:
+        groups = {'min_rows_per_group': size, 'max_rows_per_group': size}
+    ds.write_dataset(batches(), path, schema=schema, format='parquet',
+                     partitioning=partitioning,
+                     basename_template=basename,
+                     file_options=file_options,
+                     existing_data_behavior='overwrite_or_ignore', **groups)
+
+
+def _dataset(path):
+    """ Return the arrow dataset of a converted file or
+    (hive-partitioned) dataset.
+    The part files of a dataset without partitions are read in the order
+    of the parts (part-2 before part-10).
+    """
+    if os.path.isdir(path):
+        files = sorted(os.listdir(path), key=lambda f: (len(f), f))
+        if all(os.path.isfile(os.path.join(path, f)) for f in files):
+            return(ds.dataset([os.path.join(path, f) for f in files],
+                              format='parquet'))
+    return(ds.dataset(path, format='parquet', partitioning='hive'))
+
+
+def _partition_keys(dataset):
+    """ Return the partition keys of a dataset {key: column}.
+    The column is the source of the key for the keys derived from dates.
+    """
+    keys = {}
+    if getattr(dataset, 'partitioning', None) is not None:
+        names = set(dataset.schema.names)
+        for k in dataset.partitioning.schema.names:
+            c = k[:-5] if k.endswith('_year') else k
+            keys[k] = c if c in names else k
+    return(keys)
+
+
+def _dataset_columns(dataset):
+    """ Return the columns of a dataset (without the derived
+    partition keys).
+    """
+    keys = _partition_keys(dataset)
+    return([c for c in dataset.schema.names
+            if c not in keys or keys[c] == c])
+
+
+def _scalar(value, t):
+    """ Return the value as an arrow scalar of type 't'. """
+    if pa.types.is_date(t):
+        value = pd.Timestamp(value).date()
+    elif pa.types.is_timestamp(t):
+        value = pd.Timestamp(value)
+    return(pa.scalar(value, type=t))
+
+
+def _filter_condition(field, value, t, convert=_scalar):
+    """ Return the arrow condition of a filter on a field.
+    Arguments:
+        field --    Arrow field expression.
+        value --    Tuple (start, end): range (bounds included, None for
+                    no bound). List (or array): membership.
+                    Other: equality.
+        t --    Arrow type of the field.
+        convert --  Function converting a value to the type of the field.
+    """
+    if isinstance(value, tuple):
+        start, end = value
+        conds = []
+        if start is not None:
+            conds += [field >= convert(start, t)]
+        if end is not None:
+            conds += [field <= convert(end, t)]
+        if len(conds) == 0:
+            return(None)
+        return(conds[0] if len(conds) == 1 else conds[0] & conds[1])
+    elif _is_list(value):
+        values = [convert(v, t).as_py() for v in value]
+        return(field.isin(pa.array(values, type=t)))
+    else:
+        return(field == convert(value, t))
+
+
+def _year(value, t):
+    """ Return the year of a date as an arrow scalar of type 't'. """
+    return(pa.scalar(pd.Timestamp(value).year, type=t))
+
+
+def _filters_expression(dataset, filters, identifiers=None):
+    """ Return the arrow expression corresponding to the filters
+    {column: filter} (see _filter_condition).
+    The expression is pushed down to the scan: the partitions and the row
+    groups whose statistics do not match are skipped and only the
+    matching rows are converted.
+    The filters on the source column of a derived partition key (year of
+    a date) are also applied on the key to skip the partitions.
+    The filters on encoded identifiers {column: dictionary} are applied
+    on the codes.
+    """
+    if filters is None or len(filters) == 0:
+        return(None)
+    filters = _identifiers_registry.filters_codes(filters, identifiers)
+    schema = dataset.schema
+    keys = _partition_keys(dataset)
+    conds = []
+    for c, value in filters.items():
+        conds += [_filter_condition(ds.field(c), value,
+                                    schema.field(c).type)]
+        for k, kc in keys.items():
+            if kc == c and k != c:
+                conds += [_filter_condition(ds.field(k), value,
+                                            schema.field(k).type,
+                                            convert=_year)]
+    expr = None
+    for cond in conds:
+        if cond is not None:
+            expr = cond if expr is None else expr & cond
+    return(expr)
+
+
+def _filters_and(a, b):
+    """ Return the filters {column: filter} matching both filters 'a' and
+    'b' (ranges intersected, memberships intersected).
+    """
+    filters = dict(a or {})
+    for c, value in (b or {}).items():
+        if c not in filters:
+            filters[c] = value
+            continue
+        old = filters[c]
+        if isinstance(old, tuple) and isinstance(value, tuple):
+            starts = [v for v in [old[0], value[0]] if v is not None]
+            ends = [v for v in [old[1], value[1]] if v is not None]
+            filters[c] = (max(starts) if len(starts) > 0 else None,
+                          min(ends) if len(ends) > 0 else None)
+        elif not isinstance(old, tuple) and not isinstance(value, tuple):
+            old = old if _is_list(old) else [old]
+            value = set(value if _is_list(value) else [value])
+            filters[c] = [v for v in old if v in value]
+        else:
+            raise Exception("The filters on {} cannot be ".format(c) +
+                            "combined (range and values)")
+    return(filters)
+
+
+def _is_list(value):
+    return(isinstance(value, (list, set, np.ndarray, pd.Series, pd.Index)))
+
+
+def _keys_filters(t, on):
+    """ Return the filters {column: filter} selecting the keys of the
+    arrow table 't': range of the dates, values of the other keys.
+    """
+    filters = {}
+    for c in on:
+        col = t.column(c)
+        if pa.types.is_temporal(col.type):
+            mm = pc.min_max(col)
+            if mm['min'].is_valid:
+                filters[c] = (mm['min'].as_py(), mm['max'].as_py())
+            else:
+                filters[c] = []
+        else:
+            filters[c] = pc.unique(col.drop_null()).to_pylist()
+    return(filters)
+
+
+def _cast_keys(t, ref, on):
+    """ Return the arrow table 't' with the key columns 'on' of the types
+    of the table 'ref' (to be joined).
+    """
+    for c in on:
+        ct = ref.schema.field(c).type
+        if t.schema.field(c).type != ct:
+            i = t.column_names.index(c)
+            t = t.set_column(i, c, t.column(c).cast(ct))
+    return(t)
+
+
+def _filters_mask(df, filters):
+    """ Return the mask of the rows of a DataFrame matching the filters
+    {column: filter} (see _filter_condition).
+    """
+    mask = pd.Series(True, index=df.index)
+    for c, value in filters.items():
+        if isinstance(value, tuple):
+            start, end = [_like(v, df[c]) for v in value]
+            if start is not None:
+                mask &= df[c] >= start
+            if end is not None:
+                mask &= df[c] <= end
+        elif isinstance(value, (list, set, np.ndarray, pd.Series, pd.Index)):
+            mask &= df[c].isin(value)
+        else:
+            mask &= df[c] == value
+    return(mask)
+
+
+def _like(value, s):
+    """ Return the value comparable to the Series s
+    (date or timestamp).
+    """
+    if value is None or not isinstance(value, (datetime.date, np.datetime64)):
+        return(value)
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return(pd.Timestamp(value))
+    return(pd.Timestamp(value).date())
+
+
+def _filters_key(filters):
+    """ Return a hashable key of the filters {column: filter} (built from
+    all the values of the membership filters: the repr of long arrays is
+    shortened).
+    """
+    key = []
+    for k, v in (filters or {}).items():
+        if _is_list(v):
+            v = np.asarray(sorted(v) if isinstance(v, set) else v)
+            v = (str(v.dtype), tuple(v.tolist()))
+        else:
+            v = str(v)
+        key += [(k, v)]
+    return(tuple(sorted(key)))
+
+
+def _filters_dnf(filters):
+    """ Return the filters {column: filter} in the disjunctive
+    normal form used by dask.
+    """
+    if filters is None or len(filters) == 0:
+        return(None)
+    dnf = []
+    for c, value in filters.items():
+        if isinstance(value, tuple):
+            start, end = value
+            if start is not None:
+                dnf += [(c, '>=', start)]
+            if end is not None:
+                dnf += [(c, '<=', end)]
+        elif isinstance(value, (list, set, np.ndarray, pd.Series, pd.Index)):
+            dnf += [(c, 'in', list(value))]
+        else:
+            dnf += [(c, '==', value)]
+    return(dnf)
+
+
+class types_registry:
+    """ Compiled column types of the files contained in the folder 'types'
+    (and of the user provided types files).
+    The yaml files are parsed once per process and parsed again only
+    when they are modified.
+    """
+
+    # Arrow types corresponding to the types of the yaml files
+    arrow_types = {'str': pa.string(),
+                   'date': pa.date32(),
+                   'datetime64': pa.timestamp('ns'),
+                   'float': pa.float64(),
+                   'float32': pa.float32(),
+                   'float64': pa.float64(),
+                   'int8': pa.int8(),
+                   'int16': pa.int16(),
+                   'int32': pa.int32(),
+                   'int64': pa.int64(),
+                   'Int8': pa.int8(),
+                   'Int16': pa.int16(),
+                   'Int32': pa.int32(),
+                   'Int64': pa.int64()}
+
+    # Integer types (stored as float in pandas before the conversion)
+    # Lower case: numpy integers when read (float if missing values)
+    # Upper case: pandas nullable integers when read
+    int_types = ['int8', 'int16', 'int32', 'int64']
+    nullable_types = ['Int8', 'Int16', 'Int32', 'Int64']
+
+    def __init__(self):
+        self.types_dir = os.path.dirname(__file__)+'/types/'
+        self._files = {}    # {path: (mtime, {column: type})}
+        self._compiled = {}     # {files signature: compiled types}
+
+    def _read(self, path):
+        """ Return the types of a yaml file (parsed only if modified). """
+        mtime = os.stat(path).st_mtime_ns
+        if path not in self._files or self._files[path][0] != mtime:
+            with open(path) as f:
+                t = yaml.full_load(f)
+            columns_types = {}
+            dictionary = set()
             for k, l in t.items():
+                if k == 'dictionary':
+                    # Reserved key: low-cardinality columns
+                    dictionary.update(l)
+                    continue
                 for v in l:
-                    types_list1[v] = k
-                    types_list2[v] = k
-                    if k in ['Int64', 'Int32']:
-                        types_list1[v] = 'float'
-        # Select the common columns
-        cols_df = df.columns
-        cols_change = [v for v in cols_df if v in types_list2.keys()]
-        types_list_ch1 = {k: types_list1[k] for k in cols_change}
-        types_list_ch2 = {k: types_list2[k] for k in cols_change
-                          if types_list2[k] in ['Int64', 'Int32']}
-        return([types_list_ch1, types_list_ch2])
-
-    def apply_changes(ch):
-        # Apply the date and non-date types separately
-        chd = {k: v for k, v in ch.items() if v == 'date'}
-        chnd = {k: v for k, v in ch.items() if v != 'date'}
-        # Apply the non-dates
-        if len(chnd) > 0:
-            df.loc[:, chnd.keys()] = df[chnd.keys()].astype(chnd)
-        # Apply the dates
-        if len(chd) > 0:
-            for k in chd.keys():
-                df.loc[:, k] = pd.to_datetime(df[k]).dt.date
-                df.loc[df[k].isna(), k] = np.nan
-
-
-    # First use the predefined types
-    for fname in os.listdir(types_dir):
-        name, ext = os.path.splitext(fname)
-        if ext == '.yaml':
-            path = types_dir+fname
-            changes = get_changes(path)
-            for ch in changes:
-                apply_changes(ch)
-    # Then use the user provided types
-    if types is not None:
-        changes = get_changes(types)
-        for ch in changes:
-            apply_changes(ch)
+                    columns_types[v] = k
+            self._files[path] = (mtime, columns_types, dictionary)
+        return(self._files[path])
+
+    def get(self, types=None):
+        """ Return the compiled types (dictionary) of all known columns.
+        The user provided types (path of a yaml file) have precedence over
+        the predefined types.
+        Keys:
+            columns --  {column: type}
+            pandas --   {column: pandas type} (integer types as float)
+            ints -- {column: pandas nullable Int type}
+            dates --    Set of date columns
+            arrow --    {column: arrow type}
+            dictionary --   Set of low-cardinality columns (reserved key
+                            'dictionary' of the yaml files)
+            sha256 --   Hash of the types
+        """
+        paths = [self.types_dir+f for f in sorted(os.listdir(self.types_dir))
+                 if os.path.splitext(f)[1] == '.yaml']
+        if types is not None:
+            paths += [types]
+        files = [(p,) + self._read(p) for p in paths]
+        signature = tuple((p, mtime) for p, mtime, _, _ in files)
+        if signature not in self._compiled:
+            columns = {}
+            dictionary = set()
+            for _, _, columns_types, d in files:
+                columns.update(columns_types)
+                dictionary.update(d)
+            # Convert to float before Int64 (the integer types are set
+            # by the arrow schema)
+            pdtypes = {k: ('float' if v in self.int_types+self.nullable_types
+                           else v)
+                       for k, v in columns.items() if v != 'date'}
+            ints = {k: v for k, v in columns.items()
+                    if v in self.nullable_types}
+            dates = set([k for k, v in columns.items() if v == 'date'])
+            sha256 = hashlib.sha256(
+                json.dumps(sorted((str(k), str(v)) for k, v in
+                                  columns.items())).encode()).hexdigest()
+            arrow = {k: self.arrow_types[v] for k, v in columns.items()
+                     if v in self.arrow_types}
+            self._compiled[signature] = {'columns': columns,
+                                         'pandas': pdtypes,
+                                         'ints': ints,
+                                         'dates': dates,
+                                         'arrow': arrow,
+                                         'dictionary': dictionary,
+                                         'sha256': sha256}
+        return(self._compiled[signature])
+
+    def arrow_schema(self, schema, types=None):
+        """ Return the schema with the known columns set to their types. """
+        arrow = self.get(types)['arrow']
+        for i, field in enumerate(schema):
+            if field.name in arrow and field.type != arrow[field.name]:
+                schema = schema.set(i, field.with_type(arrow[field.name]))
+        return(schema)
+
+
+_types_registry = types_registry()
+
+
+class identifiers_registry:
+    """ Dictionaries of the identifiers shared by all the files of a data
+    directory (stored in the folder 'identifiers' of the data directory).
+    The identifiers are stored in the files as int32 codes (position in the
+    dictionary). The dictionaries are only appended to so that the codes of
+    the files already converted remain valid.
+    """
+
+    # Identifiers columns {column: identifier}
+    columns = {'gvkey': 'gvkey',
+               'permno': 'permno',
+               'lpermno': 'permno',
+               'ticker': 'ticker',
+               'cusip': 'cusip',
+               'ncusip': 'cusip'}
+
+    # Key of the schema metadata {column: identifier}
+    metadata_key = b'pywrds.identifiers'
+
+    def __init__(self):
+        self._files = {}    # {path: (mtime, dictionary)}
+        self._pending = {}  # {path: dictionary} (not saved yet)
+
+    def _path(self, datadir, identifier):
+        return(datadir+'identifiers/'+identifier+'.parquet')
+
+    def dictionary(self, datadir, identifier):
+        """ Return the dictionary of an identifier (arrow array) or None.
+        """
+        path = self._path(datadir, identifier)
+        if path in self._pending:
+            return(self._pending[path])
+        if not os.path.exists(path):
+            return(None)
+        mtime = os.stat(path).st_mtime_ns
+        if path not in self._files or self._files[path][0] != mtime:
+            d = pq.read_table(path).column('value').combine_chunks()
+            self._files[path] = (mtime, d)
+        return(self._files[path][1])
+
+    def dictionaries(self, datadir, dataset):
+        """ Return the dictionaries of the identifiers encoded in a dataset
+        {column: dictionary}.
+        """
+        metadata = dataset.schema.metadata or {}
+        if self.metadata_key not in metadata:
+            return({})
+        ids = json.loads(metadata[self.metadata_key])
+        return({c: self.dictionary(datadir, i) for c, i in ids.items()
+                if c in dataset.schema.names})
+
+    def encode(self, datadir, t):
+        """ Return the arrow table with the identifiers replaced by their
+        codes. The new identifiers are added to the dictionaries
+        (saved with save()).
+        """
+        ids = {}
+        for c in t.column_names:
+            if c not in self.columns:
+                continue
+            identifier = self.columns[c]
+            values = t.column(c)
+            d = self.dictionary(datadir, identifier)
+            if d is None:
+                d = pa.array([], type=values.type)
+            values = values.cast(d.type)
+            codes = pc.index_in(values, value_set=d)
+            new = pc.and_(pc.is_null(codes), pc.is_valid(values))
+            if pc.any(new).as_py():
+                new = pc.unique(pc.filter(values, new))
+                d = pa.concat_arrays([d, new])
+                self._pending[self._path(datadir, identifier)] = d
+                codes = pc.index_in(values, value_set=d)
+            t = t.set_column(t.column_names.index(c), c, codes)
+            ids[c] = identifier
+        if len(ids) > 0:
+            metadata = dict(t.schema.metadata or {})
+            metadata[self.metadata_key] = json.dumps(ids).encode()
+            t = t.replace_schema_metadata(metadata)
+        return(t)
+
+    def save(self, datadir):
+        """ Save the new identifiers of a data directory. """
+        for path in [p for p in self._pending if p.startswith(datadir)]:
+            pathlib.Path(os.path.dirname(path)).mkdir(exist_ok=True)
+            d = self._pending.pop(path)
+            pq.write_table(pa.table({'value': d}), path+'.tmp')
+            os.replace(path+'.tmp', path)
+
+    def decode(self, t, identifiers, category=False):
+        """ Return the arrow table (or batch) with the codes replaced by
+        the identifiers (dictionary arrays if category=True).
+        """
+        for c, d in identifiers.items():
+            if c not in t.column_names:
+                continue
+            codes = t.column(c)
+            if category:
+                if isinstance(codes, pa.ChunkedArray):
+                    col = pa.chunked_array(
+                        [pa.DictionaryArray.from_arrays(k, d)
+                         for k in codes.chunks],
+                        type=pa.dictionary(pa.int32(), d.type))
+                else:
+                    col = pa.DictionaryArray.from_arrays(codes, d)
+            else:
+                col = pc.take(d, codes)
+            i = t.column_names.index(c)
+            if isinstance(t, pa.RecordBatch):
+                arrays = t.columns
+                arrays[i] = col
+                t = pa.RecordBatch.from_arrays(arrays, t.column_names)
+            else:
+                t = t.set_column(i, c, col)
+        return(t)
+
+    def filters_codes(self, filters, identifiers):
+        """ Return the filters {column: filter} with the filters on the
+        encoded identifiers replaced by the matching codes.
+        """
+        if not filters or not identifiers:
+            return(filters)
+        filters = dict(filters)
+        for c, d in identifiers.items():
+            if c not in filters:
+                continue
+            cond = _filter_condition(ds.field('value'), filters[c], d.type)
+            if cond is None:
+                continue
+            t = pa.table({'value': d,
+                          'code': pa.array(np.arange(len(d), dtype='int32'))})
+            t = ds.dataset(t).to_table(columns=['code'], filter=cond)
+            filters[c] = t.column('code').to_numpy()
+        return(filters)
+
+
+_identifiers_registry = identifiers_registry()
+
+
+def _decode_codes(s, categories, category=False):
+    """ Return the identifiers of the codes s (pandas Series) given the
+    dictionary (categories).
+    """
+    codes = s.fillna(-1).astype('int32').values
+    values = pd.Categorical.from_codes(codes, categories=categories)
+    if not category:
+        values = np.asarray(values, dtype=np.asarray(categories).dtype)
+    return(pd.Series(values, index=s.index, name=s.name))
+
+
+def _import_duckdb():
+    """ Return the duckdb module (optional, used by the duckdb backend).
+    """
+    try:
+        import duckdb
+    except ImportError:
+        raise Exception("The duckdb backend requires the duckdb package " +
+                        "(pip install duckdb)")
+    return(duckdb)
+
+
+def _sql_str(s):
+    """ Return a string escaped for a SQL string literal. """
+    return(s.replace("'", "''"))
+
+
+def get_columns_types(types=None):
+    """ Return the types of all known columns as a dictionary
+    {column: type}.
+    Known columns are listed in the files contained in the folder 'types'.
+    A custom type file can be provided by the user (it has precedence over
+    the predefined types).
+    """
+    return(dict(_types_registry.get(types)['columns']))
+
+
+def _csv_names(f):
+    """ Return the (lower case) column names of a csv file from its
+    header (read by blocks).
+    """
+    header = b''
+    while b'\n' not in header:
+        block = f.read(1 << 16)
+        if not block:
+            break
+        header += block
+    header = header.split(b'\n')[0].decode('utf-8')
+    return([n.lower() for n in next(csv.reader([header]))])
+
+
+def _read_csv_arrow(f, types=None, skip_rows=0, schema=None, columns=None,
+                    names=None):
+    """ Generator of the arrow tables of a csv file read in a single pass
+    with the (multithreaded) arrow streaming reader.
+    The known column types are applied at parse time. The types of the
+    other columns are inferred on the first block of the file.
+    Arguments:
+        f --    csv file opened in binary mode.
+        types --    Path of a custom types file (yaml).
+        skip_rows --    Number of rows to skip (after the header).
+        schema --   Arrow schema of the tables (instead of inferring the
+                    types of the other columns).
+        columns --  Columns to read (None for all the columns). The other
+                    columns are not parsed.
+        names --    Column names (lower case) if the header has already
+                    been read (file not seekable, for instance
+                    decompressed on the fly).
+    """
+    if names is None:
+        # Read the header to get the (lower case) column names
+        names = _csv_names(f)
+        f.seek(0)
+    ctypes = _types_registry.get(types)
+    column_types = {c: ctypes['arrow'][c] for c in names
+                    if c in ctypes['arrow']}
+    if schema is not None:
+        column_types = {c.name: c.type for c in schema if c.name in names}
+    # Parse the dates as timestamps and the integers as floats (possibly
+    # written as '1.0') and convert them afterwards
+    casts = {c: t for c, t in column_types.items()
+             if t == pa.date32() or pa.types.is_integer(t)}
+    column_types.update({c: (pa.timestamp('s') if t == pa.date32()
+                             else pa.float64()) for c, t in casts.items()})
+    read_options = pacsv.ReadOptions(column_names=names, skip_rows=1,
+                                     skip_rows_after_names=skip_rows,
+                                     block_size=1 << 25)
+    include_columns = None
+    if columns is not None:
+        include_columns = [c for c in names if c in columns]
+        casts = {c: t for c, t in casts.items() if c in include_columns}
+    convert_options = pacsv.ConvertOptions(
+        column_types=column_types, include_columns=include_columns,
+        timestamp_parsers=[pacsv.ISO8601, '%Y%m%d', '%m/%d/%Y'])
+    reader = pacsv.open_csv(f, read_options=read_options,
+                            convert_options=convert_options)
+    for batch in reader:
+        t = pa.Table.from_batches([batch])
+        for c, ct in casts.items():
+            i = t.schema.get_field_index(c)
+            t = t.set_column(i, c, t.column(c).cast(ct))
+        yield t
+
+
+def correct_columns_types(df, types=None, date_type='date'):
+    """ Apply the correct data type to all known columns.
+    Known columns are listed in the files contained in the folder 'types'.
+    A custom type file can be provided by the user.
+    The dates are either Python dates (date_type='date') or
+    datetime64[ns] (date_type='datetime64').
+    """
+    ctypes = _types_registry.get(types)
+    cols = [c for c in df.columns if c in ctypes['columns']]
+    # Apply the non-dates
+    chnd = {k: ctypes['pandas'][k] for k in cols if k in ctypes['pandas']}
+    if len(chnd) > 0:
+        df[list(chnd.keys())] = df[list(chnd.keys())].astype(chnd)
+    chi = {k: ctypes['ints'][k] for k in cols if k in ctypes['ints']}
+    if len(chi) > 0:
+        df[list(chi.keys())] = df[list(chi.keys())].astype(chi)
+    # Apply the dates
+    for k in [c for c in cols if c in ctypes['dates']]:
+        if date_type == 'datetime64':
+            df[k] = pd.to_datetime(df[k]).dt.normalize()
+        else:
+            df[k] = pd.to_datetime(df[k]).dt.date
+            df.loc[df[k].isna(), k] = np.nan
     return(df)
@@ -5,7 +5,6 @@ Provides classes and functions to process WRDS SEC data
 from pywrds import wrds_module
 import pandas as pd
 import numpy as np
-import datetime
 
 
 class sec13f(wrds_module):
@@ -37,7 +36,7 @@ class sec13f(wrds_module):
         cols = ['cik', 'fname', 'fdate', 'rdate', 'coname', 'reporttype',
                 'amendmenttype', 'confdeniedexpired', 'tableentrytotal']
         su = self.w.open_data(self.summary, cols).drop_duplicates()
-        su = su[su.rdate >= datetime.date(2013, 6, 30)]
+        su = su[pd.to_datetime(su.rdate) >= '2013-06-30']
         su['first_fdate'] = su.groupby(key).fdate.transform('min')
         # Only consider restatements within one month after the first filing
         su = su[su.fdate - su.first_fdate < np.timedelta64(31, 'D')]
@@ -61,12 +60,20 @@ class sec13f(wrds_module):
         ###########################
         # Merge the Holdings data #
         ###########################
-        cols = ['cusip', 'fname', 'sshprnamt']
-        hol = self.w.open_data(self.holdings, cols)
-        m = suf.merge(hol, how='left', on='fname')
-        m = m.rename({'sshprnamt': 'shares'}, axis=1)
-        # Keep data after Q2-2013 when it became required
-        m['cusip'] = m.cusip.str.slice(start=0, stop=8)
+        if self.w.backend == 'duckdb':
+            # Join in the SQL engine (holdings read from the Parquet files)
+            m = self.w.sql("""
+                SELECT s.*, substr(h.cusip, 1, 8) AS cusip,
+                    h.sshprnamt AS shares
+                FROM suf s LEFT JOIN "{}" h ON s.fname = h.fname
+                """.format(self.holdings), suf=suf)
+        else:
+            cols = ['cusip', 'fname', 'sshprnamt']
+            hol = self.w.open_data(self.holdings, cols)
+            m = suf.merge(hol, how='left', on='fname')
+            m = m.rename({'sshprnamt': 'shares'}, axis=1)
+            # Keep data after Q2-2013 when it became required
+            m['cusip'] = m.cusip.str.slice(start=0, stop=8)
         m['permno'] = self.w.crsp.permno_from_cusip(m)
         # Setup the crsp module to work on monthly data
         crsp_freq = self.w.crsp.freq    # Save the current CRSP frequency
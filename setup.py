@@ -8,4 +8,8 @@ setup(name='pywrds',
       author_email='milonemario@gmail.com',
       license='BSD-3',
       packages=['pywrds'],
+      extras_require={'duckdb': ['duckdb']},
+      entry_points={
+          'console_scripts': ['pywrds-convert=pywrds.batch:main'],
+      },
       zip_safe=False)
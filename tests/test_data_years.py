@@ -0,0 +1,41 @@
+"""
+Regression tests of the years of the dates of converted data (read from
+the partitions or the parquet statistics).
+"""
+
+import tempfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pywrds as pw
+
+
+def _dates(dates):
+    return(pa.table({'date': pa.array(
+        [None if d is None else pd.Timestamp(d).date() for d in dates],
+        pa.date32())}))
+
+
+def test_data_years_statistics():
+    datadir = tempfile.mkdtemp()+'/'
+    w = pw.wrds(datadir)
+    pq.write_table(_dates(['2001-03-01', None, '1999-12-31']),
+                   datadir+'stats.parquet', row_group_size=1)
+    pq.write_table(_dates(['2001-03-01']), datadir+'nostats.parquet',
+                   write_statistics=False)
+    pq.write_table(_dates([None]), datadir+'nulls.parquet')
+    assert w.get_data_years('stats', 'date') == (1999, 2001)
+    assert w.get_data_years('nostats', 'date') == (2001, 2001)
+    assert w.get_data_years('nulls', 'date') is None
+
+
+def test_data_years_partitions():
+    datadir = tempfile.mkdtemp()+'/'
+    path = datadir+'dsf.csv'
+    pd.DataFrame({'permno': [1, 1, 2],
+                  'date': ['1998-05-01', '2000-01-03', '2003-12-31']}).to_csv(
+        path, index=False)
+    w = pw.wrds(datadir)
+    name = w.convert_data(path, partition_on='date')
+    assert w.get_partition_keys(name) == ['date_year']
+    assert w.get_data_years(name, 'date') == (1998, 2003)
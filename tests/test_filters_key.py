@@ -0,0 +1,36 @@
+"""
+Regression tests of the cache keys of the filters (open_data cache).
+"""
+
+import tempfile
+import numpy as np
+import pandas as pd
+import pywrds as pw
+from pywrds.pywrds import _filters_key
+
+
+def test_filters_key_long_arrays():
+    a = np.arange(9500, 10600)
+    b = a.copy()
+    b[500:550] = -1
+    assert _filters_key({'permno': a}) != _filters_key({'permno': b})
+    assert _filters_key({'permno': a}) == _filters_key({'permno': a.copy()})
+
+
+def test_open_data_cache_long_filters():
+    datadir = tempfile.mkdtemp()+'/'
+    path = datadir+'dsf.csv'
+    permnos = np.repeat(np.arange(9500, 10600), 3)
+    pd.DataFrame({'permno': permnos,
+                  'ret': np.arange(len(permnos), dtype=float)}).to_csv(
+        path, index=False)
+    w = pw.wrds(datadir)
+    name = w.convert_data(path)
+    a = np.arange(9500, 10600)
+    b = a.copy()
+    b[500:550] = -1
+    n_a = len(w.open_data(name, ['permno', 'ret'], filters={'permno': a}))
+    df = w.open_data(name, ['permno', 'ret'], filters={'permno': b})
+    assert n_a == len(permnos)
+    assert len(df) == len(permnos) - 150
+    assert not df.permno.isin(range(10000, 10050)).any()
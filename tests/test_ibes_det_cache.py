@@ -0,0 +1,62 @@
+"""
+Regression tests of the reuse of the IBES detail data kept in the cache
+across the forecast periods ranges.
+"""
+
+import tempfile
+import numpy as np
+import pandas as pd
+import pywrds as pw
+
+
+def _wrds():
+    datadir = tempfile.mkdtemp()+'/'
+    rng = np.random.default_rng(0)
+    fpedats = pd.date_range('2000-01-01', '2004-12-31', freq='Q')
+    det = pd.DataFrame([(t, d) for t in ['AAA', 'BBB'] for d in fpedats],
+                       columns=['ticker', 'fpedats'])
+    det['measure'] = 'EPS'
+    det['usfirm'] = 1
+    det['fpi'] = '6'
+    det['pdf'] = 'D'
+    det['analys'] = rng.integers(0, 5, len(det))
+    det['value'] = rng.normal(size=len(det))
+    det.to_csv(datadir+'det.csv', index=False)
+    w = pw.wrds(datadir)
+    w.ibes.add_file('det', datadir+'det.csv')
+    w.ibes.set_measure('EPS')
+    w.ibes.set_forecasts_pdicity('QTR')
+    w.ibes.set_forecasts_security('D')
+    w.ibes.set_unadjust(False)
+    scans = []
+    scan_det = w.ibes._scan_det
+
+    def scan(fields, filters=None):
+        scans.append(filters)
+        return(scan_det(fields, filters))
+    w.ibes._scan_det = scan
+    return(w, scans)
+
+
+def _range(start, end):
+    return({'fpedats': (pd.Timestamp(start).date(),
+                        pd.Timestamp(end).date())})
+
+
+def test_det_cache_ranges():
+    w, scans = _wrds()
+    fields = ['ticker', 'fpedats', 'value']
+    a = w.ibes._get_fields_det(fields, _range('2001-01-01', '2003-12-31'))
+    b = w.ibes._get_fields_det(['ticker', 'fpedats', 'analys'],
+                               _range('2002-01-01', '2002-12-31'))
+    assert len(scans) == 2
+    c = w.ibes._get_fields_det(fields, _range('2002-01-01', '2002-12-31'))
+    assert len(scans) == 2
+    assert len(a) == 24 and len(b) == 8 and len(c) == 8
+    # Union of the ranges
+    d = w.ibes._get_fields_det(fields, _range('2000-01-01', '2001-12-31'))
+    assert len(scans) == 3 and len(d) == 16
+    e = w.ibes._get_fields_det(fields, _range('2000-06-01', '2003-06-30'))
+    assert len(scans) == 3 and len(e) == 26
+    w.clear_cache()
+    assert w.cache_info()['columns'] == 0
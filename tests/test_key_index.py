@@ -0,0 +1,40 @@
+"""
+Regression tests of the duplicates policy of the key index (lookup).
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from pywrds.pywrds import lookup
+
+
+def _table():
+    # Key 3 is duplicated in the table
+    return(pd.DataFrame({'permno': [1, 2, 3, 3, 4],
+                         'date': [1, 1, 1, 1, np.nan],
+                         'x': [10., 20., 30., 31., 40.]}))
+
+
+def test_lookup_unmatched_duplicates():
+    data = pd.DataFrame({'permno': [2, 1, 5, 4],
+                         'date': [1, 1, 1, 1]}, index=[7, 8, 9, 9])
+    x = lookup(data, _table(), ['permno', 'date'], 'x')
+    assert x.index.tolist() == [7, 8, 9, 9]
+    assert x.iloc[0] == 20. and x.iloc[1] == 10.
+    assert x.iloc[2:].isna().all()
+
+
+def test_lookup_matched_duplicates():
+    data = pd.DataFrame({'permno': [1, 3], 'date': [1, 1]})
+    with pytest.raises(Exception, match=r'\(3, 1\)'):
+        lookup(data, _table(), ['permno', 'date'], 'x')
+    assert lookup(data, _table(), ['permno', 'date'], 'x',
+                  duplicates='first').tolist() == [10., 30.]
+    assert lookup(data, _table(), ['permno', 'date'], 'x',
+                  duplicates='last').tolist() == [10., 31.]
+
+
+def test_lookup_empty_table():
+    data = pd.DataFrame({'permno': [1, 3]})
+    x = lookup(data, _table().iloc[:0], 'permno', 'x')
+    assert x.isna().all()
@@ -0,0 +1,29 @@
+"""
+Regression tests of the CCM link indexes cached in the data directory.
+"""
+
+import os
+import tempfile
+import pytest
+import pywrds as pw
+from pywrds import crspcomp
+
+
+def test_link_index_files_by_settings(monkeypatch):
+    datadir = tempfile.mkdtemp()+'/'
+    w = pw.wrds(datadir)
+    crspcomp.link_index(w)
+    crspcomp.link_index(w, linktype=['LC', 'LU', 'LS'])
+    files = sorted(os.listdir(datadir))
+    assert len(files) == 6
+    mtimes = [os.stat(datadir+f).st_mtime_ns for f in files]
+    # Alternating settings read their own files (no rebuild)
+    crspcomp._link_indexes.clear()
+
+    def rebuild(*args):
+        pytest.fail('link index rebuilt')
+    monkeypatch.setattr(crspcomp, '_links', rebuild)
+    crspcomp.link_index(w, linktype=['LU', 'LS', 'LC'])
+    crspcomp.link_index(w)
+    assert sorted(os.listdir(datadir)) == files
+    assert [os.stat(datadir+f).st_mtime_ns for f in files] == mtimes